@@ -3,28 +3,66 @@
 Flask Web应用 - 视频处理工具
 从video_process.py拆分出来的Web界面部分
 """
+import asyncio
+import functools
 import json
+import multiprocessing
 import os
+import secrets
+import shutil
+import subprocess
 import tempfile
-import uuid
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 from dotenv import load_dotenv
-from flask import Flask, request, render_template, redirect, url_for, jsonify, send_file, abort
+from flask import Flask, Request, Response, request, render_template, redirect, url_for, jsonify, send_from_directory, abort
+from werkzeug.security import safe_join
 
-from config import OUTPUT_DIR
-from database import TaskStatus, create_tables
+from config import GUNICORN_WORKERS, MAX_CONCURRENT_ENCODES, OUTPUT_DIR
+from database import TaskStatus, create_tables, db
 from utils import success
 # 导入视频处理相关的类
-from video_process import VideoProcessor
+from video_process import VideoProcessor, prerender_bgm
 from video_processor import VideoProcessor as VP
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 load_dotenv()
 
+
+# 输出目录下的私有暂存目录：与输出文件同一文件系统，保存时仍只需重命名，但不会经 /output 暴露
+UPLOAD_SPOOL_DIR = os.path.join(OUTPUT_DIR, '.spool')
+os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+
+
+class UploadRequest(Request):
+    """上传文件直接落盘的请求类，避免Werkzeug先在内存中缓冲再二次拷贝"""
+
+    # 这些接口的上传文件最终保存到输出目录，暂存在同一文件系统的 UPLOAD_SPOOL_DIR，保存时只需重命名
+    OUTPUT_UPLOAD_PATHS = ('/maozibi_img-web',)
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool_dir = UPLOAD_SPOOL_DIR if self.path in self.OUTPUT_UPLOAD_PATHS else None
+        return tempfile.NamedTemporaryFile('wb+', prefix='.upload_', dir=spool_dir, delete=False)
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
+# 部署在nginx之后时，由nginx通过X-Accel-Redirect直接发送输出文件
+app.config['USE_X_ACCEL'] = os.getenv("USE_X_ACCEL", "").lower() in ("1", "true", "yes")
+app.config['X_ACCEL_PREFIX'] = os.getenv("X_ACCEL_PREFIX", "/internal_output/")
+# 模板编译后缓存，不在每次渲染时检查文件变更
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.auto_reload = False
 
 APP_HOST = os.getenv("APP_HOST", "http://127.0.0.1:5003")
 
@@ -32,8 +70,150 @@ APP_HOST = os.getenv("APP_HOST", "http://127.0.0.1:5003")
 STATIC_DIR = Path(__file__).parent / "static"
 STATIC_DIR.mkdir(exist_ok=True)
 
-# 线程池执行器用于后台任务
-executor = ThreadPoolExecutor(max_workers=4)
+
+def _init_worker():
+    """后台进程初始化：为子进程建立独立的数据库连接"""
+    db.connect(reuse_if_open=True)
+
+
+# 进程池执行器用于后台任务，视频处理任务互相独立，可并行占用多个CPU核心
+# 使用spawn启动子进程：gunicorn工作进程中有事件循环线程和数据库连接，fork会把持有中的锁一并复制过去
+# 每个gunicorn工作进程各有一个进程池，按工作进程数平分全机的编码并发，避免 nproc × 进程池 的超额订阅
+executor = ProcessPoolExecutor(max_workers=max(1, MAX_CONCURRENT_ENCODES // GUNICORN_WORKERS),
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker)
+
+
+def submit_task(fn, *args):
+    """提交后台任务，提交前关闭当前线程的数据库连接，连接在子进程中由 _init_worker 重新建立"""
+    db.close()
+    return executor.submit(fn, *args)
+
+
+# 常驻后台事件循环，所有协程统一派发到该循环执行（每个进程各自一个）
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _reset_loop_after_fork():
+    """子进程中事件循环线程不复存在，重置后按需重新创建"""
+    global _loop, _loop_lock
+    _loop = None
+    _loop_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_loop_after_fork)
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="async-loop", daemon=True).start()
+        return _loop
+
+
+def run_async(coro):
+    """在后台事件循环中执行协程并同步等待结果"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+# FFmpeg可用性在进程生命周期内不会变化，只检查一次
+_FFMPEG_OK = None
+
+
+def ffmpeg_available() -> bool:
+    """返回缓存的FFmpeg可用性检查结果"""
+    global _FFMPEG_OK
+    if _FFMPEG_OK is None:
+        _FFMPEG_OK = run_async(VideoProcessor.check_ffmpeg())
+    return _FFMPEG_OK
+
+
+# FFmpeg信息由后台线程在启动时探测一次，健康检查直接读取
+_FFMPEG_INFO = {"available": False, "version": "未知", "encoder": "未知"}
+
+
+def _probe_ffmpeg():
+    """探测FFmpeg可用性及版本信息"""
+    available = ffmpeg_available()
+    version = "未知"
+    if available:
+        try:
+            result = subprocess.run([VideoProcessor._ffmpeg_path, '-version'],
+                                    capture_output=True, text=True, timeout=5)
+            if result.returncode == 0:
+                # 提取版本信息的第一行
+                version = result.stdout.split('\n')[0]
+        except Exception:
+            pass
+        # 启动时完成硬件编码器探测，健康检查直接读取结果
+        _FFMPEG_INFO.update(encoder=run_async(VideoProcessor.detect_hw_encoder()))
+    _FFMPEG_INFO.update(available=available, version=version)
+    if available:
+        # 背景音乐只在Web进程启动时预渲染一次，后台子进程直接使用生成的AAC文件
+        prerender_bgm()
+
+
+# spawn出的后台子进程也会导入本模块，只在Web进程中探测
+if multiprocessing.parent_process() is None:
+    threading.Thread(target=_probe_ffmpeg, name="ffmpeg-probe", daemon=True).start()
+
+
+def save_upload(file_storage, path: str):
+    """保存上传文件，优先直接重命名已落盘的临时文件，跨文件系统时退化为分块拷贝"""
+    src = getattr(file_storage.stream, 'name', None)
+    if isinstance(src, str) and os.path.exists(src):
+        file_storage.stream.close()
+        if os.stat(src).st_dev == os.stat(os.path.dirname(path) or '.').st_dev:
+            os.replace(src, path)
+        else:
+            print(f"上传文件与目标不在同一文件系统，改为拷贝: {src} -> {path}")
+            shutil.move(src, path)
+    else:
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(file_storage.stream, f, 1 << 20)
+
+
+@app.teardown_request
+def cleanup_uploads(exc=None):
+    """清理请求中未被保存的上传临时文件"""
+    files = request.__dict__.get('files')
+    if not files:
+        return
+    for file_storage in files.values():
+        src = getattr(file_storage.stream, 'name', None)
+        if isinstance(src, str) and os.path.exists(src):
+            file_storage.stream.close()
+            os.remove(src)
+
+
+def task_temp_dir(task_id: str) -> str:
+    """返回任务专属的临时目录路径"""
+    return os.path.join(tempfile.gettempdir(), f"vlog_{task_id}")
+
+
+def sweep_stale_temp_dirs(max_age: int = 3600):
+    """清理进程异常退出后遗留的任务临时目录和上传暂存文件"""
+    tmp_root = tempfile.gettempdir()
+    now = time.time()
+    for name in os.listdir(tmp_root):
+        if not name.startswith("vlog_"):
+            continue
+        path = os.path.join(tmp_root, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+    for name in os.listdir(UPLOAD_SPOOL_DIR):
+        path = os.path.join(UPLOAD_SPOOL_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            continue
 
 
 def process_videos_background(task_id: str, video1_path: str, video2_path: str, beat_times: list = None):
@@ -73,18 +253,19 @@ def process_videos_background(task_id: str, video1_path: str, video2_path: str,
                                       video_url=video_url,
                                       completed_at=datetime.now())
 
-        # 清理临时文件
-        os.remove(video1_path)
-        os.remove(video2_path)
         del processor
 
     except Exception as e:
         TaskStatus.update_task_status(task_id, status="error", message=f"处理失败: {str(e)}", progress=0)
+    finally:
         # 清理临时文件
-        if os.path.exists(video1_path):
-            os.remove(video1_path)
-        if os.path.exists(video2_path):
-            os.remove(video2_path)
+        shutil.rmtree(task_temp_dir(task_id), ignore_errors=True)
+
+
+async def _process_maozibi(video0_path: str, video1_path: str) -> tuple[str, str]:
+    """生成maozibi视频，结束后清理处理器的临时目录"""
+    async with VideoProcessor() as processor:
+        return await processor.process_maozibi_videos(video0_path, video1_path)
 
 
 def process_maozibi_background(task_id: str, video0_path: str, video1_path: str):
@@ -93,29 +274,15 @@ def process_maozibi_background(task_id: str, video0_path: str, video1_path: str)
         # 更新任务状态为处理中
         TaskStatus.update_task_status(task_id, status="processing", message="正在处理maozibi视频...", progress=20)
 
-        processor = VideoProcessor()
-
         # 检查ffmpeg
-        import asyncio
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-        if not loop.run_until_complete(processor.check_ffmpeg()):
+        if not ffmpeg_available():
             TaskStatus.update_task_status(task_id, status="error", message="FFmpeg未安装或不可用")
             return
 
         TaskStatus.update_task_status(task_id, progress=40, message="正在分析视频...")
 
-        # 读取视频数据
-        with open(video0_path, 'rb') as f:
-            video0_data = f.read()
-        with open(video1_path, 'rb') as f:
-            video1_data = f.read()
-
-        # 处理视频
-        output_path, output_filename = loop.run_until_complete(
-            processor.process_maozibi_videos(video0_data, video1_data)
-        )
+        # 处理视频（直接传入已落盘的文件路径）
+        output_path, output_filename = run_async(_process_maozibi(video0_path, video1_path))
 
         TaskStatus.update_task_status(task_id, progress=80, message="正在生成最终文件...")
 
@@ -131,19 +298,11 @@ def process_maozibi_background(task_id: str, video0_path: str, video1_path: str)
                                       video_url=video_url,
                                       completed_at=datetime.now())
 
-        # 清理临时文件
-        os.remove(video0_path)
-        os.remove(video1_path)
-        del processor
-        loop.close()
-
     except Exception as e:
         TaskStatus.update_task_status(task_id, status="error", message=f"处理失败: {str(e)}", progress=0)
+    finally:
         # 清理临时文件
-        if os.path.exists(video0_path):
-            os.remove(video0_path)
-        if os.path.exists(video1_path):
-            os.remove(video1_path)
+        shutil.rmtree(task_temp_dir(task_id), ignore_errors=True)
 
 
 def process_maozibi_score_background(task_id: str, video0_path: str, video1_path: str, score: str):
@@ -174,18 +333,13 @@ def process_maozibi_score_background(task_id: str, video0_path: str, video1_path
                                       video_url=video_url,
                                       completed_at=datetime.now())
 
-        # 清理临时文件
-        os.remove(video0_path)
-        os.remove(video1_path)
         del processor
 
     except Exception as e:
         TaskStatus.update_task_status(task_id, status="error", message=f"处理失败: {str(e)}", progress=0)
+    finally:
         # 清理临时文件
-        if os.path.exists(video0_path):
-            os.remove(video0_path)
-        if os.path.exists(video1_path):
-            os.remove(video1_path)
+        shutil.rmtree(task_temp_dir(task_id), ignore_errors=True)
 
 
 @app.route('/tools')
@@ -218,7 +372,7 @@ def process_videos_web():
         abort(400, "第二个文件不是视频格式")
 
     # 生成任务ID
-    task_id = str(uuid.uuid4())
+    task_id = secrets.token_hex(16)
 
     # 初始化任务状态
     TaskStatus.create_task_status(task_id,
@@ -227,18 +381,19 @@ def process_videos_web():
                                   progress=0)
 
     # 保存临时文件
-    temp_dir = tempfile.mkdtemp()
+    temp_dir = task_temp_dir(task_id)
+    os.makedirs(temp_dir, exist_ok=True)
     video1_path = os.path.join(temp_dir, f"video1_{task_id}.mp4")
     video2_path = os.path.join(temp_dir, f"video2_{task_id}.mp4")
 
-    video1.save(video1_path)
-    video2.save(video2_path)
+    save_upload(video1, video1_path)
+    save_upload(video2, video2_path)
 
     # 生成状态页面URL
     status_url = f"{APP_HOST}/status/{task_id}"
 
     # 启动后台任务
-    executor.submit(process_videos_background, task_id, video1_path, video2_path, beat_times)
+    submit_task(process_videos_background, task_id, video1_path, video2_path, beat_times)
 
     task_data = TaskStatus.get_task_status(task_id)
     return success({
@@ -269,7 +424,7 @@ def maozibi_web():
         abort(400, "video1必须是视频文件")
 
     # 生成任务ID
-    task_id = str(uuid.uuid4())
+    task_id = secrets.token_hex(16)
 
     # 初始化任务状态
     TaskStatus.create_task_status(task_id,
@@ -278,12 +433,13 @@ def maozibi_web():
                                   progress=0)
 
     # 保存临时文件
-    temp_dir = tempfile.mkdtemp()
+    temp_dir = task_temp_dir(task_id)
+    os.makedirs(temp_dir, exist_ok=True)
     video0_path = os.path.join(temp_dir, f"video0_{task_id}.mp4")
     video1_path = os.path.join(temp_dir, f"video1_{task_id}.mp4")
 
-    video0.save(video0_path)
-    video1.save(video1_path)
+    save_upload(video0, video0_path)
+    save_upload(video1, video1_path)
 
     # 生成二维码URL（指向任务状态页面）
     status_url = f"{APP_HOST}/status/{task_id}"
@@ -292,7 +448,7 @@ def maozibi_web():
     TaskStatus.update_task_status(task_id, status_url=status_url)
 
     # 启动后台任务
-    executor.submit(process_maozibi_background, task_id, video0_path, video1_path)
+    submit_task(process_maozibi_background, task_id, video0_path, video1_path)
 
     task_data = TaskStatus.get_task_status(task_id)
     return success({
@@ -327,7 +483,7 @@ def maobizi_score_web():
         abort(400, "video1必须是视频文件")
 
     # 生成任务ID
-    task_id = str(uuid.uuid4())
+    task_id = secrets.token_hex(16)
 
     # 初始化任务状态
     TaskStatus.create_task_status(task_id,
@@ -336,12 +492,13 @@ def maobizi_score_web():
                                   progress=0)
 
     # 保存临时文件
-    temp_dir = tempfile.mkdtemp()
+    temp_dir = task_temp_dir(task_id)
+    os.makedirs(temp_dir, exist_ok=True)
     video0_path = os.path.join(temp_dir, f"video0_{task_id}.mp4")
     video1_path = os.path.join(temp_dir, f"video1_{task_id}.mp4")
 
-    video0.save(video0_path)
-    video1.save(video1_path)
+    save_upload(video0, video0_path)
+    save_upload(video1, video1_path)
 
     # 生成二维码URL（指向任务状态页面）  
     status_url = f"{APP_HOST}/status/{task_id}"
@@ -350,7 +507,7 @@ def maobizi_score_web():
     TaskStatus.update_task_status(task_id, status_url=status_url)
 
     # 启动后台任务
-    executor.submit(process_maozibi_score_background, task_id, video0_path, video1_path, score)
+    submit_task(process_maozibi_score_background, task_id, video0_path, video1_path, score)
 
     task_data = TaskStatus.get_task_status(task_id)
     return success({
@@ -377,7 +534,7 @@ def process_single_video_web():
         abort(400, "上传的文件必须是视频格式")
 
     # 生成任务ID
-    task_id = str(uuid.uuid4())
+    task_id = secrets.token_hex(16)
 
     # 获取文件扩展名
     file_extension = video.filename.split('.')[-1] if '.' in video.filename else 'mp4'
@@ -385,7 +542,7 @@ def process_single_video_web():
     video_path = f'{OUTPUT_DIR}/{video_filename}'
 
     # 保存视频文件
-    video.save(str(video_path))
+    save_upload(video, str(video_path))
 
     # 生成视频访问URL
     video_url = f"{APP_HOST}/output/{video_filename}"
@@ -421,25 +578,24 @@ def maozibi_img_web():
     if not image.mimetype.startswith('image/'):
         abort(400, "上传的文件必须是图片格式")
 
-    task_id = str(uuid.uuid4())
+    task_id = secrets.token_hex(16)
 
     file_extension = image.filename.rsplit('.', 1)[-1] if '.' in image.filename else 'jpg'
     image_filename = f"maozibi_img_{task_id}.{file_extension}"
     image_path = f'{OUTPUT_DIR}/{image_filename}'
 
     try:
-        image_data = image.read()
+        # 上传内容已由Werkzeug落盘，直接移动到输出目录，不在内存中复制
+        save_upload(image, image_path)
 
-        if not image_data:
-            abort(400, "图片文件数据为空")
-
-        with open(image_path, 'wb') as f:
-            f.write(image_data)
-
-        if not os.path.exists(image_path) or os.path.getsize(image_path) == 0:
+        if not os.path.exists(image_path):
             abort(500, "图片文件保存失败")
 
-        print(f"图片保存成功: {image_path}, 大小: {len(image_data)} bytes")
+        image_size = os.path.getsize(image_path)
+        if image_size == 0:
+            abort(400, "图片文件数据为空")
+
+        print(f"图片保存成功: {image_path}, 大小: {image_size} bytes")
 
         image_url = f"{APP_HOST}/output/{image_filename}"
 
@@ -469,61 +625,67 @@ def maozibi_img_web():
 @app.route('/status/<task_id>', methods=['GET', 'POST'])
 def get_task_status_page(task_id):
     """获取任务状态页面"""
-    if not TaskStatus.task_exists(task_id):
+    task = TaskStatus.get_task_status(task_id)
+    if task is None:
         abort(404, "任务不存在")
 
-    task = TaskStatus.get_task_status(task_id)
     if request.method == 'POST':
         return success(task)
-    else:
-        return render_template('status.html', task=task, task_id=task_id)
+
+    task_items = tuple(sorted(task.items()))
+    etag = f"{task['status']}-{task['progress']}-{zlib.crc32(repr(task_items).encode()):08x}"
+    if request.if_none_match.contains(etag):
+        return '', 304
+
+    resp = app.make_response(_render_status_page(task_id, task_items))
+    resp.set_etag(etag)
+    return resp
+
+
+@functools.lru_cache(maxsize=1024)
+def _render_status_page(task_id: str, task_items: tuple) -> str:
+    """渲染状态页面，任务状态不变时直接复用已渲染的HTML；二维码使用固定的状态页地址，页面内容不随查询参数变化"""
+    return render_template('status.html', task=dict(task_items), task_id=task_id,
+                           status_url=f"{APP_HOST}/status/{task_id}")
 
 
 @app.route('/output/<filename>')
 def get_output_file(filename):
     """获取输出文件（视频、二维码等）"""
-    file_path = f'{OUTPUT_DIR}/{filename}'
-    if not os.path.exists(file_path):
+    # 以.开头的是写入中的 .part_ 文件、上传暂存等，内容不完整，不能对外提供（更不能被长期缓存）
+    if filename.startswith('.'):
+        abort(404, "文件不存在")
+    file_path = safe_join(OUTPUT_DIR, filename)
+    if file_path is None or not os.path.isfile(file_path):
         abort(404, "文件不存在")
-    return send_file(file_path)
+
+    if app.config['USE_X_ACCEL']:
+        # nginx配置示例: location /internal_output/ { internal; alias /path/to/output/; }
+        resp = Response()
+        resp.headers['X-Accel-Redirect'] = f"{app.config['X_ACCEL_PREFIX']}{filename}"
+        # 交由nginx按文件扩展名确定Content-Type
+        del resp.headers['Content-Type']
+    else:
+        # send_from_directory会根据文件stat设置Content-Length和Last-Modified
+        resp = send_from_directory(OUTPUT_DIR, filename, conditional=True, etag=True)
+
+    # 输出文件名包含任务ID，内容生成后不再变化，允许浏览器和CDN长期缓存
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
 
 
 @app.route('/health')
 def health_check():
     """健康检查"""
-    import asyncio
-    import subprocess
-
-    processor = VideoProcessor()
-
-    # 检查FFmpeg
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    ffmpeg_available = loop.run_until_complete(processor.check_ffmpeg())
-
-    # 获取FFmpeg版本信息
-    ffmpeg_version = "未知"
-    if ffmpeg_available:
-        try:
-            result = subprocess.run(['ffmpeg', '-version'],
-                                    capture_output=True, text=True, timeout=5)
-            if result.returncode == 0:
-                # 提取版本信息的第一行
-                ffmpeg_version = result.stdout.split('\n')[0]
-        except:
-            pass
-
-    del processor
-    loop.close()
-
     return success({
         "status": "healthy",
-        "ffmpeg_available": ffmpeg_available,
-        "ffmpeg_version": ffmpeg_version,
+        "ffmpeg_available": _FFMPEG_INFO["available"],
+        "ffmpeg_version": _FFMPEG_INFO["version"],
+        "video_encoder": _FFMPEG_INFO["encoder"],
         "output_dir": str(OUTPUT_DIR),
         "is_docker": os.path.exists('/.dockerenv'),
         "python_version": f"{os.sys.version_info.major}.{os.sys.version_info.minor}.{os.sys.version_info.micro}",
-        "active_tasks": TaskStatus.select().count()
+        "active_tasks": TaskStatus.count_active_tasks()
     })
 
 
@@ -539,11 +701,22 @@ def favicon():
     return '', 204
 
 
+def precompile_templates():
+    """启动时预编译全部模板，后续渲染直接命中缓存"""
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+
+
+if multiprocessing.parent_process() is None:
+    precompile_templates()
+
+
 @app.cli.command("init-db")
 def init_db():
     """Initialize the database tables"""
     try:
         create_tables()
+        sweep_stale_temp_dirs()
         print("数据库初始化完成")
     except Exception as e:
         print(f"数据库初始化失败: {str(e)}")
@@ -560,4 +733,4 @@ if __name__ == '__main__':
     if is_docker:
         app.run(host='0.0.0.0', port=5003, debug=False)
     else:
-        app.run(host='127.0.0.1', port=5003, debug=True)
+        app.run(host='127.0.0.1', port=5003, debug=False, threaded=True)
@@ -10,4 +10,26 @@ DB_PATH = os.getenv('DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__fi
 
 OUTPUT_DIR = os.getenv('OUTPUT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output'))
 if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
\ No newline at end of file
+    os.makedirs(OUTPUT_DIR)
+
+
+# 同时进行的视频编码数，libx264单个编码已能占满多个核心；既是单个进程内的编码上限，
+# 也是全机后台任务数的上限（由各gunicorn工作进程的进程池平分）
+MAX_CONCURRENT_ENCODES = int(os.getenv('MAX_CONCURRENT_ENCODES', max(1, (os.cpu_count() or 2) // 2)))
+# gunicorn工作进程数，与entrypoint.sh的默认值一致；各工作进程的后台进程池按此平分 MAX_CONCURRENT_ENCODES
+GUNICORN_WORKERS = max(1, int(os.getenv('GUNICORN_WORKERS', 2)))
+# NVENC会话数受显卡限制，消费级显卡通常至少允许2路
+MAX_NVENC_SESSIONS = int(os.getenv('MAX_NVENC_SESSIONS', 2))
+# VAAPI硬件编码使用的渲染设备
+VAAPI_DEVICE = os.getenv('VAAPI_DEVICE', '/dev/dri/renderD128')
+# libx264编码速度预设和调优，成片用于网页播放，fastdecode降低播放端解码开销；X264_TUNE设为空则不指定
+X264_PRESET = os.getenv('X264_PRESET', 'veryfast')
+X264_TUNE = os.getenv('X264_TUNE', 'fastdecode')
+# MP4封装的movflags，设为 +frag_keyframe+empty_moov+default_base_moof 可单次写出分片MP4，
+# 省去+faststart的整文件重写；默认保持+faststart，兼容旧播放器并保证ffprobe能读到时长
+MP4_MOVFLAGS = os.getenv('MP4_MOVFLAGS', '+faststart')
+# 由 MP4_MOVFLAGS 得到的MP4封装参数，两个处理器共用：+faststart需要写完后再整体重写一遍把moov移到文件头；
+# 分片MP4(frag_keyframe+empty_moov)一次写完，moov已在文件头，按1秒切分片避免单个分片过大
+MP4_OUTPUT_ARGS = ['-movflags', MP4_MOVFLAGS]
+if 'frag_keyframe' in MP4_MOVFLAGS:
+    MP4_OUTPUT_ARGS += ['-frag_duration', '1000000']
@@ -12,9 +12,18 @@ logger = logging.getLogger(__name__)
 class DatabaseConfig:
     """数据库配置类"""
 
+    # WAL模式下读写互不阻塞，后台任务并发写进度时不会阻塞状态页轮询
+    PRAGMAS = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -64000,  # 64MB
+        'foreign_keys': 1,
+        'busy_timeout': 5000,
+    }
+
     def __init__(self, db_path: str = 'app.db'):
         self.db_path = db_path
-        self.database = SqliteDatabase(db_path)
+        self.database = SqliteDatabase(db_path, pragmas=self.PRAGMAS)
 
     def get_database(self):
         return self.database
@@ -38,12 +47,18 @@ class BaseModel(Model):
         self.updated_at = datetime.now()
         return super().save(*args, **kwargs)
 
+    @classmethod
+    def _field_names(cls) -> tuple:
+        """字段名元组，每个模型类只计算一次"""
+        names = cls.__dict__.get('_FIELD_NAMES')
+        if names is None:
+            names = tuple(cls._meta.fields)
+            cls._FIELD_NAMES = names
+        return names
+
     def to_dict(self) -> Dict[str, Any]:
         """将模型转换为字典"""
-        return {
-            field.name: getattr(self, field.name)
-            for field in self._meta.fields.values()
-        }
+        return {name: getattr(self, name) for name in self._field_names()}
 
 
 class CRUDMixin:
@@ -137,7 +152,7 @@ class CRUDMixin:
 class TaskStatus(BaseModel):
     """任务状态模型"""
     task_id = CharField(unique=True, max_length=50)
-    status = CharField(max_length=20, default='pending')  # pending, processing, completed, error
+    status = CharField(max_length=20, default='pending', index=True)  # pending, processing, completed, error
     message = TextField(default='')
     progress = IntegerField(default=0)
     created_at = DateTimeField(default=datetime.now)
@@ -153,38 +168,35 @@ class TaskStatus(BaseModel):
     def get_task_status(cls, task_id: str) -> dict:
         """获取任务状态"""
         try:
-            task = TaskStatus.get(cls.task_id == task_id)
-            return {
-                "status": task.status,
-                "message": task.message,
-                "progress": task.progress,
-                "created_at": task.created_at.isoformat(),
-                "completed_at": task.completed_at.isoformat() if task.completed_at else None,
-                "video_filename": task.video_filename,
-                "video_url": task.video_url,
-                "status_url": task.status_url
-            }
+            task = (cls.select(cls.status, cls.message, cls.progress, cls.created_at, cls.completed_at,
+                               cls.video_filename, cls.video_url, cls.status_url)
+                    .where(cls.task_id == task_id)
+                    .dicts()
+                    .get())
         except cls.DoesNotExist:
             return None
+        task["created_at"] = task["created_at"].isoformat()
+        task["completed_at"] = task["completed_at"].isoformat() if task["completed_at"] else None
+        return task
 
     @classmethod
     def update_task_status(cls, task_id: str, **kwargs):
-        """更新任务状态"""
-        try:
-            task = cls.get(cls.task_id == task_id)
-            for key, value in kwargs.items():
-                if hasattr(task, key):
-                    setattr(task, key, value)
-            task.save()
-            return True
-        except cls.DoesNotExist:
-            return False
+        """更新任务状态（单条UPDATE语句，不预先加载整行）"""
+        fields = cls._meta.fields
+        data = {key: value for key, value in kwargs.items() if key in fields}
+        data['updated_at'] = datetime.now()
+        return cls.update(**data).where(cls.task_id == task_id).execute() > 0
 
     @classmethod
     def create_task_status(cls, task_id: str, **kwargs):
         """创建新的任务状态"""
         return cls.create(task_id=task_id, **kwargs)
 
+    @classmethod
+    def count_active_tasks(cls) -> int:
+        """统计未结束的任务数量（走status索引，不随历史任务增长）"""
+        return cls.select().where(cls.status.in_(['pending', 'processing'])).count()
+
     @classmethod
     def task_exists(cls, task_id: str) -> bool:
         """检查任务是否存在"""
@@ -20,4 +20,12 @@ flask init-db
 echo "Starting Gunicorn..."
 # 用 exec "$@" 来执行 CMD 中指定的命令，或者直接启动 Gunicorn
 # exec "$@"
-gunicorn  -w 4 --bind 0.0.0.0:7082 app:app # 根据您的应用调整
\ No newline at end of file
+# 多进程 × 多线程处理大文件上传与状态页轮询，避免互相阻塞
+# 视频处理在各工作进程的后台进程池中进行，工作进程数默认取较小的固定值，编码并发由 MAX_CONCURRENT_ENCODES 控制
+# 使用gthread而非gevent：应用内有asyncio后台事件循环线程和进程池，不兼容gevent的monkey patch
+exec gunicorn -k gthread \
+  -w "${GUNICORN_WORKERS:-2}" \
+  --threads "${GUNICORN_THREADS:-8}" \
+  --timeout 600 \
+  --bind 0.0.0.0:7082 \
+  app:app
\ No newline at end of file
@@ -12,8 +12,7 @@ def check_dependencies():
     """检查必要的依赖"""
     try:
         import flask
-        import ffmpeg
-        import qrcode
+        import segno
         print("✅ 所有依赖检查通过")
         return True
     except ImportError as e:
@@ -60,7 +59,7 @@ def main():
     # 导入并启动应用
     try:
         from app import app
-        app.run(host='127.0.0.1', port=5000, debug=True)
+        app.run(host='127.0.0.1', port=5000, debug=False, threaded=True)
     except KeyboardInterrupt:
         print("\n👋 服务已停止")
     except Exception as e:
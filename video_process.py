@@ -4,109 +4,557 @@
 包含视频处理和二维码生成的核心业务逻辑
 """
 
+import atexit
+import contextlib
+import functools
+import io
+import json
+import multiprocessing
 import os
 import uuid
 import tempfile
 import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Literal, Optional
 import asyncio
-import subprocess
 
-import qrcode
+try:
+    import segno
+except ImportError:
+    # 未安装segno时退回qrcode+PIL
+    segno = None
+    import qrcode
 
-from config import OUTPUT_DIR
+from config import (MAX_CONCURRENT_ENCODES, MAX_NVENC_SESSIONS, MP4_OUTPUT_ARGS, OUTPUT_DIR, VAAPI_DEVICE,
+                    X264_PRESET, X264_TUNE)
 
 # MoviePy v2 导入
 try:
-    from moviepy import VideoFileClip, AudioFileClip, CompositeVideoClip, TextClip, concatenate_videoclips, concatenate_audioclips
+    from moviepy import VideoFileClip
 except ImportError as e:
     print(f"MoviePy 导入错误: {e}")
     print("请确保 MoviePy v2 已正确安装: pip install moviepy==2.2.1")
 
 
+# 尚未关闭的处理器临时目录，进程退出时兜底清理
+_live_temp_dirs = set()
+
+
+@atexit.register
+def _remove_live_temp_dirs():
+    """进程退出时删除未通过aclose清理的临时目录"""
+    for path in list(_live_temp_dirs):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# 可用内存盘空间低于该值时不使用/dev/shm
+SHM_MIN_FREE = 2 * 1024 ** 3
+
+
+def fast_temp_base():
+    """优先把中间文件放在/dev/shm内存盘，空间不足或不可写时返回None使用系统临时目录"""
+    try:
+        if os.access('/dev/shm', os.W_OK):
+            stat = os.statvfs('/dev/shm')
+            if stat.f_bavail * stat.f_frsize >= SHM_MIN_FREE:
+                return '/dev/shm'
+    except OSError:
+        pass
+    return None
+
+
+# 背景音乐预渲染目录：MP3转码为AAC，合成时仍按 -stream_loop 循环，音频可直接流复制
+BGM_CACHE_DIR = os.path.join(tempfile.gettempdir(), "diy_vlog_bgm")
+BGM_FILES = ("jiggy boogy.mp3", "bgm_mbz.mp3")
+
+
+def bgm_aac_path(music_path: str) -> str:
+    """返回背景音乐对应的预渲染AAC文件路径"""
+    return os.path.join(BGM_CACHE_DIR, Path(music_path).stem.replace(' ', '_') + ".m4a")
+
+
+def prerender_bgm():
+    """将背景音乐预先转码为AAC（只转码一遍，循环由合成时的 -stream_loop 完成），已存在则跳过；需先调用 check_ffmpeg"""
+    if not VideoProcessor._ffmpeg_path:
+        return
+    os.makedirs(BGM_CACHE_DIR, exist_ok=True)
+    for name in BGM_FILES:
+        music_path = str(Path(__file__).parent / name)
+        aac_path = bgm_aac_path(music_path)
+        if not os.path.exists(music_path) or os.path.exists(aac_path):
+            continue
+        tmp_path = f"{aac_path}.{os.getpid()}.tmp.m4a"
+        try:
+            result = subprocess.run(
+                [VideoProcessor._ffmpeg_path, '-y', '-v', 'error', '-i', music_path,
+                 '-c:a', 'aac', '-b:a', '128k', '-ar', '48000', tmp_path],
+                capture_output=True, text=True)
+            if result.returncode == 0:
+                os.replace(tmp_path, aac_path)
+            else:
+                print(f"背景音乐预渲染失败: {result.stderr}")
+        except Exception as e:
+            print(f"背景音乐预渲染失败: {e}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+@contextlib.contextmanager
+def atomic_output(output_path: str):
+    """
+    在输出文件同目录生成 .part_ 临时文件供写入，成功后 os.replace 原子改名，失败时删除，避免暴露未写完的文件
+
+    临时文件名唯一，并保留输出文件的后缀以便 ffmpeg 识别容器格式；两个处理器共用
+    """
+    directory, name = os.path.split(os.path.abspath(output_path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.part_', suffix=os.path.splitext(name)[1],
+                                     delete=False) as tf:
+        partial_path = tf.name
+    try:
+        yield partial_path
+        os.replace(partial_path, output_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def _close_clips(*clips):
+    """安全地清理视频剪辑以释放内存"""
+    for clip in clips:
+        if clip is not None:
+            try:
+                clip.close()
+            except Exception:
+                pass  # 忽略清理错误
+
+
+def _moviepy_write_segment(input_path: str, output_path: str, start_time: float, end_time: float,
+                           write_opts: dict):
+    """在进程池中用MoviePy逐帧精确截取片段并编码"""
+    with VideoFileClip(input_path) as clip:
+        segment = clip.subclipped(start_time, end_time)
+        try:
+            segment.write_videofile(output_path, **write_opts)
+        finally:
+            _close_clips(segment)
+
+
+class ProbeCache:
+    """ffprobe结果缓存，以(绝对路径, 修改时间, 文件大小)为键，文件变化后自动失效"""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path: str) -> tuple:
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, key: tuple):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value: dict):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+@dataclass(frozen=True)
+class PipelineSpec:
+    """process_*流水线描述：合成方式（拼接/画中画/带分数画中画）、输出文件名前缀、分数文字"""
+    mode: Literal['concat', 'pip', 'pip_score']
+    output_prefix: str
+    score: Optional[str] = None
+
+
 class VideoProcessor:
     """视频处理类 - 使用 MoviePy 优化"""
     
-    def __init__(self):
-        self.temp_dir = tempfile.mkdtemp()
+    def __init__(self, max_concurrent_encodes: int = MAX_CONCURRENT_ENCODES,
+                 max_nvenc_sessions: int = MAX_NVENC_SESSIONS):
+        self.temp_dir = tempfile.mkdtemp(dir=fast_temp_base())
+        _live_temp_dirs.add(self.temp_dir)
+        self._cleanup_tasks = set()
+        # 同时进行的编码数上限，信号量在每个事件循环首次编码时按此创建
+        self.max_concurrent_encodes = max_concurrent_encodes
+        self.max_nvenc_sessions = max_nvenc_sessions
         # 设置 MoviePy 的默认线程数以提高性能
         os.environ.setdefault('MOVIEPY_NUMTHREADS', '4')
     
-    def __del__(self):
-        """清理临时目录"""
-        if hasattr(self, 'temp_dir') and os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir, ignore_errors=True)
+    # 软件编码参数
+    LIBX264_OPTS = {
+        'codec': 'libx264',
+        'preset': X264_PRESET,  # 默认 veryfast，比 fast 快约30%，体积相差很小
+        'ffmpeg_params': ['-crf', '23', '-pix_fmt', 'yuv420p', *MP4_OUTPUT_ARGS,  # 调整 CRF 平衡质量和速度
+                          *(['-tune', X264_TUNE] if X264_TUNE else [])],
+    }
+    # NVIDIA NVENC硬件编码参数
+    NVENC_OPTS = {
+        'codec': 'h264_nvenc',
+        'preset': 'p4',
+        'ffmpeg_params': ['-rc', 'vbr', '-cq', '19', '-pix_fmt', 'yuv420p', *MP4_OUTPUT_ARGS],
+    }
+    # Intel Quick Sync，可直接接收内存中的nv12帧
+    QSV_OPTS = {
+        'codec': 'h264_qsv',
+        'preset': 'veryfast',
+        'ffmpeg_params': ['-global_quality', '19', '-pix_fmt', 'nv12', *MP4_OUTPUT_ARGS],
+    }
+    # AMD/Intel VAAPI，需要先把帧上传到显存
+    VAAPI_OPTS = {
+        'codec': 'h264_vaapi',
+        'preset': None,
+        'ffmpeg_params': ['-vaapi_device', VAAPI_DEVICE, '-rc_mode', 'CQP', '-qp', '19', *MP4_OUTPUT_ARGS],
+        'hw_upload': 'format=nv12,hwupload',
+    }
+    # Apple VideoToolbox
+    VIDEOTOOLBOX_OPTS = {
+        'codec': 'h264_videotoolbox',
+        'preset': None,
+        'ffmpeg_params': ['-q:v', '55', '-pix_fmt', 'yuv420p', *MP4_OUTPUT_ARGS],
+    }
+    # AMD AMF (Windows)
+    AMF_OPTS = {
+        'codec': 'h264_amf',
+        'preset': None,
+        'ffmpeg_params': ['-usage', 'transcoding', '-quality', 'balanced', '-rc', 'cqp',
+                          '-qp_i', '20', '-qp_p', '22', '-pix_fmt', 'yuv420p', *MP4_OUTPUT_ARGS],
+    }
+    # MoviePy写文件的公共参数
+    MOVIEPY_WRITE_OPTS = {
+        'audio_codec': 'aac',
+        'remove_temp': True,
+        'logger': None,
+        'threads': 4,  # 使用多线程编码
+    }
+    # 硬件编码器按优先级探测，都不可用时回退到libx264
+    HW_ENCODER_OPTS = (NVENC_OPTS, QSV_OPTS, VAAPI_OPTS, VIDEOTOOLBOX_OPTS, AMF_OPTS)
+    # ffmpeg可执行文件路径，空字符串表示不可用，进程内所有实例共享
+    _ffmpeg_path = None
+    # 编码器探测结果，进程内所有实例共享
+    _vcodec_opts = None
+    # 按(编码器, 线程数)预先构造好的命令行参数和MoviePy参数，进程内所有实例共享
+    _encode_args_cache = {}
+    _moviepy_opts_cache = {}
+    # 编码并发信号量，同一事件循环内所有实例共享
+    _encode_sem = None
+    _encode_sem_loop = None
+    # CUDA滤镜(scale_cuda/overlay_cuda)探测结果，进程内所有实例共享
+    _cuda_filters_ok = None
+    # MoviePy编码进程池，进程内所有实例共享
+    _moviepy_executor = None
+    # ffprobe结果缓存，进程内所有实例共享
+    probe_cache = ProbeCache()
+    # 正在进行的ffprobe任务，按缓存键去重
+    _probe_inflight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        """在线程中删除临时目录，可重复调用"""
+        if self.temp_dir in _live_temp_dirs:
+            _live_temp_dirs.discard(self.temp_dir)
+            await asyncio.to_thread(shutil.rmtree, self.temp_dir, ignore_errors=True)
     
-    def _cleanup_clips(self, *clips):
-        """安全地清理视频剪辑以释放内存"""
-        for clip in clips:
-            if clip is not None:
+    @staticmethod
+    def _write_file(path: str, data: bytes, mode: int = 0o644):
+        """直接通过文件描述符写入数据，跳过Python缓冲IO的额外拷贝"""
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            view = memoryview(data)
+            # os.write可能只写入部分数据，循环直到写完
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    @contextlib.asynccontextmanager
+    async def _scratch_dir(self):
+        """本次调用专用的临时子目录，并发调用之间互不干扰，退出时（包括异常）在后台整体删除"""
+        path = tempfile.mkdtemp(dir=self.temp_dir)
+        try:
+            yield path
+        finally:
+            self._discard_dir(path)
+
+    def _discard_dir(self, path: str):
+        """在后台线程中删除目录，调用方无需等待删除完成"""
+        task = asyncio.get_running_loop().create_task(
+            asyncio.to_thread(shutil.rmtree, path, ignore_errors=True))
+        # 保留任务引用，避免任务在完成前被垃圾回收
+        self._cleanup_tasks.add(task)
+        task.add_done_callback(self._cleanup_tasks.discard)
+
+    @classmethod
+    async def _pick_vcodec(cls) -> dict:
+        """选择视频编码器，按NVENC、QSV、VAAPI、VideoToolbox、AMF的顺序使用第一个可用的硬件编码，否则回退到libx264"""
+        if VideoProcessor._vcodec_opts is None:
+            # 探测结果先放在局部变量中，全部探测完成后再写入类属性，
+            # 避免并发协程在探测期间读到临时的libx264回退值
+            picked = cls.LIBX264_OPTS
+            try:
+                encoders = await cls._run_ffmpeg('-hide_banner', '-encoders')
+            except Exception:
+                encoders = b''
+            for opts in cls.HW_ENCODER_OPTS:
+                if f" {opts['codec']} ".encode() in encoders and await cls._encoder_works(opts):
+                    print(f"使用 {opts['codec']} 硬件编码")
+                    picked = opts
+                    break
+            if VideoProcessor._vcodec_opts is None:
+                VideoProcessor._vcodec_opts = picked
+        return VideoProcessor._vcodec_opts
+
+    @classmethod
+    async def detect_hw_encoder(cls) -> str:
+        """探测并缓存本机使用的H.264编码器名称，启动时调用可避免首个任务承担探测耗时"""
+        return (await cls._pick_vcodec())['codec']
+
+    @staticmethod
+    async def _encoder_works(opts: dict) -> bool:
+        """用编码参数实际编码一帧，确认硬件和驱动可用"""
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                VideoProcessor._ffmpeg_path or 'ffmpeg', '-hide_banner', '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+                '-frames:v', '1', *VideoProcessor._vcodec_args(opts), '-f', 'null', '-',
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            return await proc.wait() == 0
+        except (FileNotFoundError, OSError):
+            return False
+
+    @staticmethod
+    def _vcodec_args(opts: dict, filtered: bool = False) -> list:
+        """将编码参数转换为ffmpeg命令行参数，filtered=True时上传滤镜已并入filter_complex"""
+        args = ['-c:v', opts['codec']]
+        if opts['preset']:
+            args += ['-preset', opts['preset']]
+        if opts.get('hw_upload') and not filtered:
+            args += ['-vf', opts['hw_upload']]
+        return args + opts['ffmpeg_params']
+
+    async def _moviepy_codec_opts(self) -> dict:
+        """MoviePy write_videofile使用的编码参数，每种编码器只构造一次"""
+        opts = await self._pick_vcodec()
+        threads = self._encoder_threads(opts)
+        codec_opts = VideoProcessor._moviepy_opts_cache.get((opts['codec'], threads))
+        if codec_opts is None:
+            params = list(opts['ffmpeg_params'])
+            if opts.get('hw_upload'):
+                params += ['-vf', opts['hw_upload']]
+            codec_opts = {'codec': opts['codec'], 'ffmpeg_params': params, **self.MOVIEPY_WRITE_OPTS}
+            if opts['preset']:
+                codec_opts['preset'] = opts['preset']
+            if threads:
+                codec_opts['threads'] = threads
+            VideoProcessor._moviepy_opts_cache[(opts['codec'], threads)] = codec_opts
+        return codec_opts
+
+    def _encoder_threads(self, opts: dict):
+        """软件编码时按并发上限平分CPU核心，避免多个libx264同时各自占满全部核心；硬件编码返回None"""
+        if opts['codec'] != 'libx264':
+            return None
+        return max(1, (os.cpu_count() or 1) // max(1, self.max_concurrent_encodes))
+
+    @classmethod
+    def _moviepy_pool(cls) -> ProcessPoolExecutor:
+        """MoviePy编码使用的进程池，首次使用时创建；用spawn启动，避免在带事件循环线程的进程中fork"""
+        if VideoProcessor._moviepy_executor is None:
+            VideoProcessor._moviepy_executor = ProcessPoolExecutor(
+                max_workers=max(1, (os.cpu_count() or 1) // 4),
+                mp_context=multiprocessing.get_context('spawn'))
+        return VideoProcessor._moviepy_executor
+
+    async def _run_moviepy(self, fn, *args):
+        """在编码并发限制内把MoviePy编码交给进程池执行，fn的最后一个参数为写文件参数"""
+        write_opts = dict(await self._moviepy_codec_opts())
+        # 临时音频文件也放在临时目录中，不写到输出目录
+        write_opts['temp_audiofile'] = os.path.join(self.temp_dir, f"audio_{uuid.uuid4()}.m4a")
+        async with await self._encode_slot():
+            await asyncio.get_running_loop().run_in_executor(self._moviepy_pool(), fn, *args, write_opts)
+
+    async def _hw_upload_filter(self) -> str:
+        """需要显存帧的编码器(VAAPI)在滤镜链末尾追加的上传滤镜"""
+        opts = await self._pick_vcodec()
+        return f",{opts['hw_upload']}" if opts.get('hw_upload') else ''
+
+    async def _encode_slot(self) -> asyncio.Semaphore:
+        """返回编码并发信号量，避免多个编码同时抢占全部CPU核心或NVENC会话"""
+        opts = await self._pick_vcodec()
+        loop = asyncio.get_running_loop()
+        if VideoProcessor._encode_sem_loop is not loop:
+            size = self.max_nvenc_sessions if opts['codec'] == 'h264_nvenc' else self.max_concurrent_encodes
+            VideoProcessor._encode_sem = asyncio.Semaphore(max(1, size))
+            VideoProcessor._encode_sem_loop = loop
+        return VideoProcessor._encode_sem
+
+    async def _cuda_filters_available(self) -> bool:
+        """NVENC可用且ffmpeg编译了scale_cuda和overlay_cuda时，画中画可全程在显存中完成"""
+        if VideoProcessor._cuda_filters_ok is None:
+            VideoProcessor._cuda_filters_ok = False
+            if (await self._pick_vcodec())['codec'] == 'h264_nvenc':
                 try:
-                    clip.close()
+                    stdout = await self._run_ffmpeg('-hide_banner', '-filters')
+                    VideoProcessor._cuda_filters_ok = b' scale_cuda ' in stdout and b' overlay_cuda ' in stdout
                 except Exception:
-                    pass  # 忽略清理错误
-    
-    async def check_ffmpeg(self) -> bool:
-        """检查moviepy/ffmpeg是否可用"""
+                    pass
+        return VideoProcessor._cuda_filters_ok
+
+    @staticmethod
+    async def _run_command(*cmd) -> bytes:
+        """异步执行外部命令并返回stdout，失败时抛出异常"""
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            lines = stderr.decode(errors='ignore').strip().splitlines()
+            raise Exception(lines[-1] if lines else f"{cmd[0]} 退出码: {proc.returncode}")
+        return stdout
+
+    @classmethod
+    async def _run_ffmpeg(cls, *args) -> bytes:
+        """执行ffmpeg，优先使用check_ffmpeg找到的可执行文件"""
+        return await cls._run_command(VideoProcessor._ffmpeg_path or 'ffmpeg', *args)
+
+    async def _probe(self, path: str) -> dict:
+        """使用ffprobe获取视频的流和容器信息，同一文件只探测一次"""
+        key = ProbeCache.key(path)
+        probe = self.probe_cache.get(key)
+        if probe is not None:
+            return probe
+        # 同一文件的并发探测共用一个ffprobe进程
+        task = VideoProcessor._probe_inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(self._run_probe(path, key))
+            VideoProcessor._probe_inflight[key] = task
+            task.add_done_callback(
+                lambda t: VideoProcessor._probe_inflight.pop(key)
+                if VideoProcessor._probe_inflight.get(key) is t else None)
+        # shield避免某个调用方被取消时连带取消其他调用方等待的探测
+        return await asyncio.shield(task)
+
+    async def _run_probe(self, path: str, key: tuple) -> dict:
+        """执行ffprobe并写入缓存"""
+        stdout = await self._run_command(
+            'ffprobe', '-v', 'error', '-show_streams', '-show_format', '-of', 'json', path)
+        probe = json.loads(stdout)
+        self.probe_cache.put(key, probe)
+        return probe
+
+    async def _streams_compatible(self, *paths: str) -> bool:
+        """判断多个视频的音视频流参数是否一致（可直接流复制拼接）"""
+        keys = ('codec_type', 'codec_name', 'profile', 'width', 'height', 'pix_fmt',
+                'sample_aspect_ratio', 'time_base', 'sample_rate', 'channels')
         try:
-            # 尝试创建一个简单的视频剪辑来测试moviepy是否正常工作
-            test_clip = VideoFileClip("test.mp4", logger=None) if os.path.exists("test.mp4") else None
-            if test_clip:
-                test_clip.close()
-            print("MoviePy is available and ready to use")
-            return True
+            probes = await asyncio.gather(*(self._probe(path) for path in paths))
         except Exception:
-            # 如果moviepy不可用，回退到检查ffmpeg
-            try:
-                ffmpeg_paths = ['ffmpeg', '/usr/bin/ffmpeg', '/usr/local/bin/ffmpeg']
-                
-                for ffmpeg_path in ffmpeg_paths:
-                    try:
-                        result = subprocess.run([ffmpeg_path, '-version'], 
-                                              capture_output=True, text=True, timeout=10)
-                        if result.returncode == 0:
-                            print(f"FFmpeg found at: {ffmpeg_path}")
-                            return True
-                    except FileNotFoundError:
-                        continue
-                
-                print("MoviePy/FFmpeg not available")
-                return False
-                
-            except Exception as e:
-                print(f"Video processing check error: {e}")
-                return False
-    
-    async def get_video_duration(self, video_path: str) -> float:
-        """获取视频时长"""
+            return False
+        signatures = [[tuple(stream.get(key) for key in keys) for stream in probe.get('streams', [])]
+                      for probe in probes]
+        return all(signature == signatures[0] for signature in signatures[1:])
+
+    async def _concat_copy(self, paths: list, output_path: str):
+        """使用concat demuxer流复制拼接视频，只重新封装不重新编码"""
+        # 列表文件放在本次调用的临时子目录，不在输出目录留下残留
+        async with self._scratch_dir() as scratch:
+            list_path = os.path.join(scratch, "concat.txt")
+            with open(list_path, 'w', encoding='utf-8') as f:
+                for path in paths:
+                    escaped = os.path.abspath(path).replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
+            await self._run_ffmpeg(
+                '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                '-c', 'copy', *MP4_OUTPUT_ARGS, output_path)
+
+    async def _concat_reencode(self, paths: list, output_path: str):
+        """参数不一致时用concat滤镜拼接，统一缩放到第一个视频的尺寸后一次编码"""
+        probes = await asyncio.gather(*(self._probe(path) for path in paths))
+        _, width, height = self._video_info(probes[0])
+        width, height = width // 2 * 2, height // 2 * 2
+        has_audio = all(any(st.get('codec_type') == 'audio' for st in probe['streams']) for probe in probes)
+
+        inputs, filters, labels = [], [], ''
+        for i, path in enumerate(paths):
+            inputs += ['-i', path]
+            filters.append(f"[{i}:v]scale={width}:{height},setsar=1[v{i}]")
+            labels += f"[v{i}]" + (f"[{i}:a]" if has_audio else '')
+        filter_graph = ';'.join(filters) + (
+            f";{labels}concat=n={len(paths)}:v=1:a={int(has_audio)}"
+            f"{'[vc][a]' if has_audio else '[vc]'};[vc]null{await self._hw_upload_filter()}[v]")
+        await self._run_to_output([
+            '-y', '-v', 'error', *inputs,
+            '-filter_complex', filter_graph,
+            '-map', '[v]', *(['-map', '[a]', '-c:a', 'aac'] if has_audio else []),
+            *await self._encode_args()],
+            output_path)
+
+    @classmethod
+    async def check_ffmpeg(cls) -> bool:
+        """检查ffmpeg是否可用，查找结果进程内缓存"""
+        if VideoProcessor._ffmpeg_path is None:
+            VideoProcessor._ffmpeg_path = shutil.which('ffmpeg') or next(
+                (path for path in ('/usr/bin/ffmpeg', '/usr/local/bin/ffmpeg') if os.access(path, os.X_OK)), '')
+            if VideoProcessor._ffmpeg_path:
+                print(f"FFmpeg found at: {VideoProcessor._ffmpeg_path}")
+            else:
+                print("FFmpeg not available")
+        return bool(VideoProcessor._ffmpeg_path)
+
+    async def get_video_duration(self, video_path: str, probe: dict = None) -> float:
+        """获取视频时长，已有ffprobe结果时可直接传入"""
         try:
-            with VideoFileClip(video_path) as clip:
-                duration = clip.duration
-            return duration
+            probe = probe or await self._probe(video_path)
+            return float(probe['format']['duration'])
         except Exception as e:
             raise Exception(f"无法获取视频时长: {str(e)}")
     
+    async def _ffmpeg_cut_copy(self, input_path: str, output_path: str, start_time: float, duration: float):
+        """从start_time之前最近的关键帧开始流复制截取片段，只重新封装不重新编码"""
+        # -ss放在-i之前为快速定位，配合-c copy只重新封装
+        await self._run_ffmpeg(
+            '-y', '-v', 'error',
+            '-ss', str(start_time), '-t', str(duration), '-i', input_path,
+            '-c', 'copy', '-avoid_negative_ts', 'make_zero', *MP4_OUTPUT_ARGS,
+            output_path)
+
     async def extract_video_segment(self, input_path: str, output_path: str, 
-                                  start_time: float, duration: float) -> bool:
-        """提取视频片段"""
+                                  start_time: float, duration: float, frame_exact: bool = False) -> bool:
+        """提取视频片段，默认按关键帧流复制；frame_exact=True时逐帧精确截取并重新编码"""
         try:
-            with VideoFileClip(input_path) as clip:
-                # 提取指定时间段的视频片段
-                end_time = start_time + duration
-                segment = clip.subclipped(start_time, end_time)
-                
-                # 写入文件，使用优化的编码参数
-                segment.write_videofile(
-                    output_path,
-                    codec='libx264',
-                    audio_codec='aac',
-                    temp_audiofile=f"{output_path}_temp_audio.m4a",
-                    remove_temp=True,
-                    preset='fast',  # 使用 fast preset 提高速度
-                    ffmpeg_params=['-crf', '23', '-pix_fmt', 'yuv420p', '-movflags', '+faststart'],  # 调整 CRF 平衡质量和速度
-                    logger=None
-                )
-                self._cleanup_clips(segment)
+            if not frame_exact:
+                if self._is_web_h264(await self._probe(input_path)):
+                    await self._ffmpeg_cut_copy(input_path, output_path, start_time, duration)
+                else:
+                    # 非H.264/yuv420p（如手机拍摄的HEVC）流复制后网页无法播放，截取时转码
+                    opts = await self._pick_vcodec()
+                    threads = self._encoder_threads(opts)
+                    await self._run_to_output([
+                        '-y', '-v', 'error',
+                        '-ss', str(start_time), '-t', str(duration), '-i', input_path,
+                        *self._vcodec_args(opts), *(['-threads', str(threads)] if threads else []),
+                        '-c:a', 'aac'],
+                        output_path)
+                return True
+
+            await self._run_moviepy(_moviepy_write_segment, input_path, output_path,
+                                    start_time, start_time + duration)
             return True
         except Exception as e:
             raise Exception(f"视频片段提取失败: {str(e)}")
@@ -115,172 +563,64 @@ class VideoProcessor:
                                output_path: str) -> bool:
         """拼接两个视频"""
         try:
-            # 使用 moviepy 加载两个视频
-            clip1 = VideoFileClip(video1_path)
-            clip2 = VideoFileClip(video2_path)
-            
-            # 拼接视频
-            final_clip = concatenate_videoclips([clip1, clip2])
-            
-            # 写入输出文件
-            final_clip.write_videofile(
-                output_path,
-                codec='libx264',
-                audio_codec='aac',
-                temp_audiofile=f"{output_path}_temp_audio.m4a",
-                remove_temp=True,
-                preset='fast',  # 使用 fast preset 提高速度
-                ffmpeg_params=['-crf', '23', '-pix_fmt', 'yuv420p', '-movflags', '+faststart'],  # 调整 CRF 平衡质量和速度
-
-                logger=None,
-                threads=4  # 使用多线程编码
-            )
-            
-            # 清理资源
-            self._cleanup_clips(clip1, clip2, final_clip)
-            
+            # 编码参数一致时直接用concat demuxer拼接，不重新编码
+            if await self._streams_compatible(video1_path, video2_path):
+                try:
+                    await self._concat_copy([video1_path, video2_path], output_path)
+                    return True
+                except Exception as e:
+                    # 参数相同但SPS/PPS等不兼容时流复制仍可能失败，回退到重新编码
+                    print(f"流复制拼接失败，回退到重新编码: {str(e)}")
+
+            await self._concat_reencode([video1_path, video2_path], output_path)
             return True
         except Exception as e:
             raise Exception(f"视频拼接失败: {str(e)}")
     
+    @staticmethod
+    def _music_source(music_path: str) -> tuple[str, bool]:
+        """返回实际使用的背景音乐文件，以及它是否为预渲染的AAC"""
+        aac_path = bgm_aac_path(music_path)
+        if os.path.exists(aac_path):
+            return aac_path, True
+        return music_path, False
+
+    async def _mux_music(self, input_path: str, output_path: str, music_path: str):
+        """复制视频流并替换为循环的背景音乐，音乐已是AAC时音频也直接复制"""
+        music_path, music_is_aac = self._music_source(music_path)
+        if music_is_aac:
+            # 预渲染的音乐必定是AAC，只需探测视频时长
+            video_probe = await self._probe(input_path)
+        else:
+            video_probe, music_probe = await asyncio.gather(self._probe(input_path), self._probe(music_path))
+            music_is_aac = any(stream.get('codec_type') == 'audio' and stream.get('codec_name') == 'aac'
+                               for stream in music_probe.get('streams', []))
+        duration = float(video_probe['format']['duration'])
+        await self._run_ffmpeg(
+            '-y', '-v', 'error',
+            '-i', input_path,
+            '-stream_loop', '-1', '-i', music_path,
+            '-map', '0:v:0', '-map', '1:a:0',
+            '-c:v', 'copy', '-c:a', 'copy' if music_is_aac else 'aac',
+            '-t', str(duration), *MP4_OUTPUT_ARGS,
+            output_path)
+
     async def add_background_music(self, input_path: str, output_path: str) -> bool:
         """为视频添加背景音乐"""
         try:
             music_path = str(Path(__file__).parent / "jiggy boogy.mp3")
-            
-            # 加载视频和音频
-            video_clip = VideoFileClip(input_path)
-            audio_clip = AudioFileClip(music_path)
-            
-            # 如果音频比视频短，循环播放音频
-            if audio_clip.duration < video_clip.duration:
-                # 计算需要循环的次数
-                loops = int(video_clip.duration / audio_clip.duration) + 1
-                # 使用 concatenate_audioclips 创建循环效果，确保每个副本都是独立的
-                looped_clips = []
-                for i in range(loops):
-                    # 创建音频的独立副本以避免维度不匹配
-                    clip_copy = audio_clip.subclipped(0, audio_clip.duration)
-                    looped_clips.append(clip_copy)
-                
-                try:
-                    audio_clip = concatenate_audioclips(looped_clips)
-                except Exception as concat_error:
-                    # 如果拼接失败，使用简单的重复方法
-                    print(f"音频拼接失败，使用备用方法: {concat_error}")
-                    # 使用第一个音频片段，重复到所需长度
-                    single_duration = audio_clip.duration
-                    target_duration = video_clip.duration
-                    audio_clip = audio_clip.subclipped(0, min(single_duration, target_duration))
-                    if single_duration < target_duration:
-                        # 使用音频自身的loop功能
-                        audio_clip = audio_clip.loop(duration=target_duration)
-                
-                # 截取到确切的视频长度
-                audio_clip = audio_clip.subclipped(0, video_clip.duration)
-                
-                # 清理临时片段
-                for clip in looped_clips:
-                    try:
-                        clip.close()
-                    except:
-                        pass
-            else:
-                # 如果音频比视频长，截取音频
-                audio_clip = audio_clip.subclipped(0, video_clip.duration)
-            
-            # 将背景音乐添加到视频中
-            final_clip = video_clip.with_audio(audio_clip)
-            
-            # 写入输出文件
-            final_clip.write_videofile(
-                output_path,
-                codec='libx264',
-                audio_codec='aac',
-                temp_audiofile=f"{output_path}_temp_audio.m4a",
-                remove_temp=True,
-                preset='fast',  # 使用 fast preset 提高速度
-                ffmpeg_params=['-crf', '23', '-pix_fmt', 'yuv420p', '-movflags', '+faststart'],  # 调整 CRF 平衡质量和速度
-
-                logger=None,
-                threads=4  # 使用多线程编码
-            )
-            
-            # 清理资源
-            self._cleanup_clips(video_clip, audio_clip, final_clip)
-            
+            await self._mux_music(input_path, output_path, music_path)
             return True
         except Exception as e:
             raise Exception(f"添加背景音乐失败: {str(e)}")
     
     async def add_background_music_maozibi(self, input_path: str, output_path: str) -> bool:
-        """为maozibi视频添加背景音乐，使用jiggy boogy2.mp3"""
+        """为maozibi视频添加背景音乐，使用bgm_mbz.mp3"""
         try:
             music_path = str(Path(__file__).parent / "bgm_mbz.mp3")
             if not os.path.exists(music_path):
-                raise Exception("背景音乐文件jiggy boogy2.mp3不存在")
-            
-            # 加载视频和音频
-            video_clip = VideoFileClip(input_path)
-            audio_clip = AudioFileClip(music_path)
-            
-            # 如果音频比视频短，循环播放音频
-            if audio_clip.duration < video_clip.duration:
-                # 计算需要循环的次数
-                loops = int(video_clip.duration / audio_clip.duration) + 1
-                # 使用 concatenate_audioclips 创建循环效果，确保每个副本都是独立的
-                looped_clips = []
-                for i in range(loops):
-                    # 创建音频的独立副本以避免维度不匹配
-                    clip_copy = audio_clip.subclipped(0, audio_clip.duration)
-                    looped_clips.append(clip_copy)
-                
-                try:
-                    audio_clip = concatenate_audioclips(looped_clips)
-                except Exception as concat_error:
-                    # 如果拼接失败，使用简单的重复方法
-                    print(f"音频拼接失败，使用备用方法: {concat_error}")
-                    # 使用第一个音频片段，重复到所需长度
-                    single_duration = audio_clip.duration
-                    target_duration = video_clip.duration
-                    audio_clip = audio_clip.subclipped(0, min(single_duration, target_duration))
-                    if single_duration < target_duration:
-                        # 使用音频自身的loop功能
-                        audio_clip = audio_clip.loop(duration=target_duration)
-                
-                # 截取到确切的视频长度
-                audio_clip = audio_clip.subclipped(0, video_clip.duration)
-                
-                # 清理临时片段
-                for clip in looped_clips:
-                    try:
-                        clip.close()
-                    except:
-                        pass
-            else:
-                # 如果音频比视频长，截取音频
-                audio_clip = audio_clip.subclipped(0, video_clip.duration)
-            
-            # 将背景音乐添加到视频中
-            final_clip = video_clip.with_audio(audio_clip)
-            
-            # 写入输出文件
-            final_clip.write_videofile(
-                output_path,
-                codec='libx264',
-                audio_codec='aac',
-                temp_audiofile=f"{output_path}_temp_audio.m4a",
-                remove_temp=True,
-                preset='fast',  # 使用 fast preset 提高速度
-                ffmpeg_params=['-crf', '23', '-pix_fmt', 'yuv420p', '-movflags', '+faststart'],  # 调整 CRF 平衡质量和速度
-
-                logger=None,
-                threads=4  # 使用多线程编码
-            )
-            
-            # 清理资源
-            self._cleanup_clips(video_clip, audio_clip, final_clip)
-            
+                raise Exception("背景音乐文件bgm_mbz.mp3不存在")
+            await self._mux_music(input_path, output_path, music_path)
             return True
         except Exception as e:
             raise Exception(f"添加背景音乐失败: {str(e)}")
@@ -289,44 +629,8 @@ class VideoProcessor:
                                         output_path: str) -> bool:
         """创建画中画效果"""
         try:
-            # 加载主视频和覆盖视频
-            main_clip = VideoFileClip(main_video_path)
-            overlay_clip = VideoFileClip(overlay_video_path)
-            
-            # 获取主视频的尺寸
-            main_width, main_height = main_clip.size
-            
-            # 计算覆盖视频的大小和位置
-            overlay_width = main_width // 4
-            overlay_height = main_height // 4
-            overlay_x = main_width - overlay_width - 10
-            overlay_y = 10
-            
-            # 调整覆盖视频的大小和位置
-            overlay_resized = overlay_clip.resized((overlay_width, overlay_height))
-            overlay_positioned = overlay_resized.with_position((overlay_x, overlay_y))
-            
-            # 创建画中画效果
-            final_clip = CompositeVideoClip([main_clip, overlay_positioned])
-            
-            # 写入输出文件
-            final_clip.write_videofile(
-                output_path,
-                codec='libx264',
-                audio_codec='aac',
-                temp_audiofile=f"{output_path}_temp_audio.m4a",
-                remove_temp=True,
-                preset='fast',  # 使用 fast preset 提高速度
-                ffmpeg_params=['-crf', '23', '-pix_fmt', 'yuv420p', '-movflags', '+faststart'],  # 调整 CRF 平衡质量和速度
-
-                logger=None,
-                threads=4  # 使用多线程编码
-            )
-            
-            # 清理资源
-            self._cleanup_clips(main_clip, overlay_clip, overlay_resized, overlay_positioned, final_clip)
-            
-            return True
+            return await self.compose_picture_in_picture(main_video_path, overlay_video_path, output_path,
+                                                         with_music=False)
         except Exception as e:
             raise Exception(f"画中画创建失败: {str(e)}")
 
@@ -334,231 +638,268 @@ class VideoProcessor:
                                                    output_path: str, score: str) -> bool:
         """创建带分数显示的画中画效果"""
         try:
-            # 加载主视频和覆盖视频
-            main_clip = VideoFileClip(main_video_path)
-            overlay_clip = VideoFileClip(overlay_video_path)
-            
-            # 获取主视频的尺寸
-            main_width, main_height = main_clip.size
-            
-            # 计算覆盖视频的大小和位置
-            overlay_width = main_width // 4
-            overlay_height = main_height // 4
-            overlay_x = main_width - overlay_width - 10
-            overlay_y = 10
-            
-            # 调整覆盖视频的大小和位置
-            overlay_resized = overlay_clip.resized((overlay_width, overlay_height))
-            overlay_positioned = overlay_resized.with_position((overlay_x, overlay_y))
-            
-            # 创建画中画效果
-            pip_clip = CompositeVideoClip([main_clip, overlay_positioned])
-            
-            # 创建分数文本
-            font_size = max(24, main_width // 40)
-            text_clip = TextClip(
-                score,
-                fontsize=font_size,
-                color='white',
-                font='Arial-Bold'
-            ).with_position((20, 20)).with_duration(pip_clip.duration)
-            
-            # 合成最终视频（添加文本）
-            final_clip = CompositeVideoClip([pip_clip, text_clip])
-            
-            # 写入输出文件
-            final_clip.write_videofile(
-                output_path,
-                codec='libx264',
-                audio_codec='aac',
-                temp_audiofile=f"{output_path}_temp_audio.m4a",
-                remove_temp=True,
-                preset='fast',  # 使用 fast preset 提高速度
-                ffmpeg_params=['-crf', '23', '-pix_fmt', 'yuv420p', '-movflags', '+faststart'],  # 调整 CRF 平衡质量和速度
-
-                logger=None,
-                threads=4  # 使用多线程编码
+            return await self.compose_picture_in_picture(main_video_path, overlay_video_path, output_path,
+                                                         score, with_music=False)
+        except Exception as e:
+            raise Exception(f"带分数的画中画创建失败: {str(e)}")
+
+    async def _encode_args(self) -> list:
+        """将视频编码参数转换为ffmpeg命令行参数，每种编码器只构造一次"""
+        opts = await self._pick_vcodec()
+        threads = self._encoder_threads(opts)
+        args = VideoProcessor._encode_args_cache.get((opts['codec'], threads))
+        if args is None:
+            args = self._vcodec_args(opts, filtered=True)
+            if threads:
+                args += ['-threads', str(threads)]
+            VideoProcessor._encode_args_cache[(opts['codec'], threads)] = args
+        return args
+
+    async def _run_to_output(self, cmd: list, output_path: str):
+        """ffmpeg先写入同目录临时文件，成功后原子改名，避免暴露未写完的文件，见 atomic_output"""
+        with atomic_output(output_path) as partial_path:
+            async with await self._encode_slot():
+                await self._run_ffmpeg(*cmd, partial_path)
+
+    @staticmethod
+    def _is_web_h264(probe: dict) -> bool:
+        """视频流已是网页可直接播放的H.264 yuv420p时，截取和拼接可以直接流复制"""
+        video_stream = next((st for st in probe['streams'] if st.get('codec_type') == 'video'), {})
+        return video_stream.get('codec_name') == 'h264' and video_stream.get('pix_fmt') == 'yuv420p'
+
+    @staticmethod
+    def _video_info(probe: dict) -> tuple[float, int, int]:
+        """从ffprobe结果中提取时长和画面尺寸"""
+        video_stream = next(s for s in probe['streams'] if s.get('codec_type') == 'video')
+        return float(probe['format']['duration']), int(video_stream['width']), int(video_stream['height'])
+
+    async def _build_process_videos_command(self, video1_path: str, video2_path: str,
+                                            mix_original_audio: bool = False) -> tuple[list, float]:
+        """构造截取、拼接、背景音乐一次完成的ffmpeg参数，返回(不含ffmpeg本身和输出路径的参数列表, 输出时长)"""
+        probe1, probe2 = await asyncio.gather(self._probe(video1_path), self._probe(video2_path))
+        duration1, width, height = self._video_info(probe1)
+        duration2, _, _ = self._video_info(probe2)
+
+        segment_duration1 = min(10, int(duration1))
+        segment_duration2 = min(10, int(duration2))
+        start_time2 = max(0, int(duration2) - segment_duration2)
+        total_duration = segment_duration1 + segment_duration2
+
+        # 第二段缩放到第一段的尺寸，concat滤镜要求输入尺寸一致
+        width, height = width // 2 * 2, height // 2 * 2
+        filter_graph = (
+            f"[0:v]scale={width}:{height},setsar=1[v0];"
+            f"[1:v]scale={width}:{height},setsar=1[v1];"
+            f"[v0][v1]concat=n=2:v=1:a=0{await self._hw_upload_filter()}[v]"
+        )
+        music_path, music_is_aac = self._music_source(str(Path(__file__).parent / "jiggy boogy.mp3"))
+
+        has_audio = all(any(st.get('codec_type') == 'audio' for st in probe['streams'])
+                        for probe in (probe1, probe2))
+        if mix_original_audio and has_audio:
+            # 原声拼接后与背景音乐混音，音频必须重新编码
+            filter_graph += (
+                ";[0:a][1:a]concat=n=2:v=0:a=1[va];"
+                "[va][2:a]amix=inputs=2:duration=first[a]"
             )
-            
-            # 清理资源
-            self._cleanup_clips(main_clip, overlay_clip, overlay_resized, overlay_positioned, pip_clip, text_clip, final_clip)
-            
+            audio_args = ['-map', '[a]', '-c:a', 'aac']
+        else:
+            audio_args = ['-map', '2:a', '-c:a', 'copy' if music_is_aac else 'aac']
+
+        cmd = [
+            '-y', '-v', 'error',
+            '-ss', '0', '-t', str(segment_duration1), '-i', video1_path,
+            # 从结尾截取，按关键帧快速定位即可，无需逐帧精确定位
+            '-noaccurate_seek', '-ss', str(start_time2), '-t', str(segment_duration2), '-i', video2_path,
+            '-stream_loop', '-1', '-i', music_path,
+            '-filter_complex', filter_graph,
+            '-map', '[v]', *await self._encode_args(), *audio_args,
+            '-t', str(total_duration),
+        ]
+        return cmd, total_duration
+
+    async def process_videos_fused(self, video1_path: str, video2_path: str, output_path: str,
+                                   mix_original_audio: bool = False) -> bool:
+        """单次ffmpeg调用完成片段截取、拼接和背景音乐合成，不产生中间文件；
+        mix_original_audio=True时保留原声并与背景音乐混音"""
+        try:
+            cmd, _ = await self._build_process_videos_command(video1_path, video2_path, mix_original_audio)
+            await self._run_to_output(cmd, output_path)
             return True
         except Exception as e:
-            raise Exception(f"带分数的画中画创建失败: {str(e)}")
+            raise Exception(f"视频合成失败: {str(e)}")
+
+    async def compose_picture_in_picture(self, main_video_path: str, overlay_video_path: str,
+                                         output_path: str, score: str = None, with_music: bool = True) -> bool:
+        """单次ffmpeg调用完成时长对齐、画中画叠加、分数文字和背景音乐合成，不产生中间文件；
+        with_music=False时保留主视频原声，时长与主视频一致"""
+        scratch = None
+        try:
+            if with_music:
+                music_path = str(Path(__file__).parent / "bgm_mbz.mp3")
+                if not os.path.exists(music_path):
+                    raise Exception("背景音乐文件bgm_mbz.mp3不存在")
+
+            # 顺带完成编码器和CUDA滤镜探测，与两个输入的探测并行
+            probe0, probe1, use_cuda = await asyncio.gather(
+                self._probe(main_video_path), self._probe(overlay_video_path), self._cuda_filters_available())
+            duration0, main_width, main_height = self._video_info(probe0)
+            duration1, _, _ = self._video_info(probe1)
+
+            # 覆盖视频为主视频的1/4大小，位于右上角
+            overlay_width = main_width // 4 // 2 * 2
+            overlay_height = main_height // 4 // 2 * 2
+            if score:
+                # 分数写入文件再交给drawtext，避免滤镜参数转义问题
+                scratch = tempfile.mkdtemp(dir=self.temp_dir)
+                score_path = os.path.join(scratch, "score.txt")
+                with open(score_path, 'w', encoding='utf-8') as f:
+                    f.write(score)
+                font_size = max(24, main_width // 40)
+                drawtext = f"drawtext=textfile='{score_path}':x=20:y=20:fontsize={font_size}:fontcolor=white"
+
+            if with_music:
+                music_path, music_is_aac = self._music_source(music_path)
+                music_input = ['-stream_loop', '-1', '-i', music_path]
+                output_opts = [
+                    '-map', '[v]', '-map', '2:a',
+                    '-c:a', 'copy' if music_is_aac else 'aac',
+                    '-t', str(min(duration0, duration1)),
+                ]
+            else:
+                # 覆盖视频先结束时保持最后一帧，输出随主视频结束
+                music_input = []
+                output_opts = ['-map', '[v]', '-map', '0:a?', '-c:a', 'aac']
+
+            if use_cuda:
+                # 解码、缩放、叠加都在显存中完成，直接交给h264_nvenc，省去每帧两次显存与内存间的拷贝
+                filter_graph = (
+                    f"[1:v]scale_cuda={overlay_width}:{overlay_height}[ov];"
+                    f"[0:v][ov]overlay_cuda=x={main_width - overlay_width - 10}:y=10"
+                )
+                if score:
+                    # drawtext没有CUDA版本，下载一次到内存绘制后由NVENC直接编码
+                    filter_graph += f",hwdownload,format=nv12,{drawtext}"
+                filter_graph += "[v]"
+                # 显存帧不能做-pix_fmt转换，由NVENC沿用输入格式
+                vcodec_opts = self.NVENC_OPTS
+                params = list(vcodec_opts['ffmpeg_params'])
+                del params[params.index('-pix_fmt'):params.index('-pix_fmt') + 2]
+                try:
+                    await self._run_to_output([
+                        '-y', '-v', 'error',
+                        '-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda', '-i', main_video_path,
+                        '-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda', '-i', overlay_video_path,
+                        *music_input,
+                        '-filter_complex', filter_graph,
+                        '-c:v', vcodec_opts['codec'], '-preset', vcodec_opts['preset'], *params,
+                        *output_opts],
+                        output_path)
+                    return True
+                except Exception as e:
+                    # 例如10bit HEVC等CUDA解码或overlay_cuda不支持的像素格式，回退到CPU滤镜
+                    print(f"CUDA画中画失败，回退到CPU滤镜: {str(e)}")
+
+            filter_graph = (
+                f"[1:v]scale={overlay_width}:{overlay_height}[ov];"
+                "[0:v][ov]overlay=x=main_w-overlay_w-10:y=10"
+            )
+            if score:
+                filter_graph += f",{drawtext}"
+            filter_graph += f"{await self._hw_upload_filter()}[v]"
+
+            await self._run_to_output([
+                '-y', '-v', 'error',
+                '-i', main_video_path,
+                '-i', overlay_video_path,
+                *music_input,
+                '-filter_complex', filter_graph,
+                *await self._encode_args(),
+                *output_opts],
+                output_path)
+            return True
+        except Exception as e:
+            raise Exception(f"画中画合成失败: {str(e)}")
+        finally:
+            if scratch:
+                self._discard_dir(scratch)
+
+    async def _stage_input(self, path: str, data: bytes):
+        """写入一个输入视频并预先探测其流信息"""
+        # 不通过管道直接喂给ffmpeg：需要先ffprobe时长才能确定截取位置，
+        # 且手机视频的moov常在文件末尾，必须可随机读取；上传的中间文件仅本进程可读
+        await asyncio.to_thread(self._write_file, path, data, 0o600)
+        await self._probe(path)
 
     async def process_videos(self, video1_data: bytes, video2_data: bytes) -> tuple[str, str]:
         """处理两个视频文件"""
-        unique_id = str(uuid.uuid4())
-        
         if not video1_data or len(video1_data) == 0:
             raise Exception("第一个视频文件数据为空")
         if not video2_data or len(video2_data) == 0:
             raise Exception("第二个视频文件数据为空")
         
-        video1_path = os.path.join(self.temp_dir, f"video1_{unique_id}.mp4")
-        video2_path = os.path.join(self.temp_dir, f"video2_{unique_id}.mp4")
-        
-        try:
-            with open(video1_path, 'wb') as f:
-                f.write(video1_data)
-            with open(video2_path, 'wb') as f:
-                f.write(video2_data)
-            
-            duration1 = await self.get_video_duration(video1_path)
-            duration2 = await self.get_video_duration(video2_path)
-            
-            segment1_path = os.path.join(self.temp_dir, f"segment1_{unique_id}.mp4")
-            segment2_path = os.path.join(self.temp_dir, f"segment2_{unique_id}.mp4")
-            
-            segment_duration1 = min(10, int(duration1))
-            await self.extract_video_segment(video1_path, segment1_path, 0, segment_duration1)
-            
-            segment_duration2 = min(10, int(duration2))
-            start_time2 = max(0, int(duration2) - segment_duration2)
-            await self.extract_video_segment(video2_path, segment2_path, start_time2, segment_duration2)
-            
-            output_filename = f"merged_{unique_id}.mp4"
-            output_path = f'{OUTPUT_DIR}/{output_filename}'
-            
-            await self.concatenate_videos(segment1_path, segment2_path, str(output_path))
-            
-            final_output = os.path.join(self.temp_dir, f"final_{unique_id}.mp4")
-            await self.add_background_music(str(output_path), final_output)
-            shutil.move(final_output, output_path)
-            
-            for temp_file in [video1_path, video2_path, segment1_path, segment2_path]:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-            
-            return str(output_path), output_filename
-        except Exception as e:
-            for path in [video1_path, video2_path]:
-                if os.path.exists(path):
-                    os.remove(path)
-            raise
+        async with self._scratch_dir() as req_dir:
+            video1_path = os.path.join(req_dir, "video1.mp4")
+            video2_path = os.path.join(req_dir, "video2.mp4")
 
+            # 两个输入各自写盘后立即探测，互不等待；探测结果进入缓存供合成命令直接使用
+            await asyncio.gather(self._stage_input(video1_path, video1_data),
+                                 self._stage_input(video2_path, video2_data))
 
-    async def process_maozibi_videos(self, video0_data: bytes, video1_data: bytes) -> tuple[str, str]:
-        """处理两个视频文件，创建画中画效果"""
-        unique_id = str(uuid.uuid4())
-        
-        if not video0_data or len(video0_data) == 0:
-            raise Exception("video0文件数据为空")
-        if not video1_data or len(video1_data) == 0:
-            raise Exception("video1文件数据为空")
+            return await self._process(PipelineSpec('concat', 'merged'), video1_path, video2_path)
 
-        video0_path = os.path.join(self.temp_dir, f"video0_{unique_id}.mp4")
-        video1_path = os.path.join(self.temp_dir, f"video1_{unique_id}.mp4")
-        
-        try:
-            with open(video0_path, 'wb') as f:
-                f.write(video0_data)
-            with open(video1_path, 'wb') as f:
-                f.write(video1_data)
-            
-            duration0 = await self.get_video_duration(video0_path)
-            duration1 = await self.get_video_duration(video1_path)
-            
-            final_duration = min(duration0, duration1)
-            
-            trimmed_video0_path = video0_path
-            trimmed_video1_path = video1_path
-            
-            if duration0 > final_duration:
-                trimmed_video0_path = os.path.join(self.temp_dir, f"trimmed_video0_{unique_id}.mp4")
-                await self.extract_video_segment(video0_path, trimmed_video0_path, 0, final_duration)
-            
-            if duration1 > final_duration:
-                trimmed_video1_path = os.path.join(self.temp_dir, f"trimmed_video1_{unique_id}.mp4")
-                await self.extract_video_segment(video1_path, trimmed_video1_path, 0, final_duration)
-            
-            pip_path = os.path.join(self.temp_dir, f"pip_maozibi_{unique_id}.mp4")
-            await self.create_picture_in_picture(trimmed_video0_path, trimmed_video1_path, pip_path)
-            
-            output_filename = f"maozibi_{unique_id}.mp4"
-            output_path = f'{OUTPUT_DIR}/{output_filename}'
-            
-            await self.add_background_music_maozibi(pip_path, str(output_path))
-            
-            temp_files = [video0_path, video1_path, pip_path]
-            if trimmed_video0_path != video0_path:
-                temp_files.append(trimmed_video0_path)
-            if trimmed_video1_path != video1_path:
-                temp_files.append(trimmed_video1_path)
-            
-            for temp_file in temp_files:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-            
-            return str(output_path), output_filename
-        except Exception as e:
-            for path in [video0_path, video1_path]:
-                if os.path.exists(path):
-                    os.remove(path)
-            raise
+    async def process_maozibi_videos(self, video0_path: str, video1_path: str) -> tuple[str, str]:
+        """处理两个视频文件，创建画中画效果"""
+        return await self._process(PipelineSpec('pip', 'maozibi'), video0_path, video1_path)
 
-    async def process_maozibi_score_videos(self, video0_data: bytes, video1_data: bytes, score: str) -> tuple[str, str]:
+    async def process_maozibi_score_videos(self, video0_path: str, video1_path: str, score: str) -> tuple[str, str]:
         """处理两个视频文件，创建带分数显示的画中画效果"""
-        unique_id = str(uuid.uuid4())
-        
-        if not video0_data or len(video0_data) == 0:
+        return await self._process(PipelineSpec('pip_score', 'maozibi_score', score), video0_path, video1_path)
+
+    async def _process(self, spec: PipelineSpec, video0_path: str, video1_path: str) -> tuple[str, str]:
+        """按spec校验输入并执行对应的单次ffmpeg合成，返回(输出路径, 输出文件名)"""
+        if not os.path.exists(video0_path) or os.path.getsize(video0_path) == 0:
             raise Exception("video0文件数据为空")
-        if not video1_data or len(video1_data) == 0:
+        if not os.path.exists(video1_path) or os.path.getsize(video1_path) == 0:
             raise Exception("video1文件数据为空")
-        if not score or score.strip() == "":
+        if spec.mode == 'pip_score' and (not spec.score or spec.score.strip() == ""):
             raise Exception("score参数不能为空")
 
-        
-        video0_path = os.path.join(self.temp_dir, f"video0_{unique_id}.mp4")
-        video1_path = os.path.join(self.temp_dir, f"video1_{unique_id}.mp4")
-        
-        try:
-            with open(video0_path, 'wb') as f:
-                f.write(video0_data)
-            with open(video1_path, 'wb') as f:
-                f.write(video1_data)
-            
-            duration0 = await self.get_video_duration(video0_path)
-            duration1 = await self.get_video_duration(video1_path)
-            
-            final_duration = min(duration0, duration1)
-            
-            trimmed_video0_path = video0_path
-            trimmed_video1_path = video1_path
-            
-            if duration0 > final_duration:
-                trimmed_video0_path = os.path.join(self.temp_dir, f"trimmed_video0_{unique_id}.mp4")
-                await self.extract_video_segment(video0_path, trimmed_video0_path, 0, final_duration)
-            
-            if duration1 > final_duration:
-                trimmed_video1_path = os.path.join(self.temp_dir, f"trimmed_video1_{unique_id}.mp4")
-                await self.extract_video_segment(video1_path, trimmed_video1_path, 0, final_duration)
-            
-            pip_path = os.path.join(self.temp_dir, f"pip_maozibi_score_{unique_id}.mp4")
-            await self.create_picture_in_picture_with_score(trimmed_video0_path, trimmed_video1_path, pip_path, score)
-            
-            output_filename = f"maozibi_score_{unique_id}.mp4"
-            output_path = f'{OUTPUT_DIR}/{output_filename}'
-            
-            await self.add_background_music_maozibi(pip_path, str(output_path))
-            
-            temp_files = [video0_path, video1_path, pip_path]
-            if trimmed_video0_path != video0_path:
-                temp_files.append(trimmed_video0_path)
-            if trimmed_video1_path != video1_path:
-                temp_files.append(trimmed_video1_path)
-            
-            for temp_file in temp_files:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-            
-            return str(output_path), output_filename
-        except Exception as e:
-            for path in [video0_path, video1_path]:
-                if os.path.exists(path):
-                    os.remove(path)
-            raise
+        output_filename = f"{spec.output_prefix}_{uuid.uuid4()}.mp4"
+        output_path = f'{OUTPUT_DIR}/{output_filename}'
+
+        if spec.mode == 'concat':
+            await self.process_videos_fused(video0_path, video1_path, output_path)
+        else:
+            await self.compose_picture_in_picture(video0_path, video1_path, output_path, spec.score)
+
+        return output_path, output_filename
+
+
+def _reset_moviepy_pool_after_fork():
+    """fork出的子进程不能复用父进程的进程池，首次使用时重新创建"""
+    VideoProcessor._moviepy_executor = None
+
+
+os.register_at_fork(after_in_child=_reset_moviepy_pool_after_fork)
+
+
+@functools.lru_cache(maxsize=256)
+def _qr_png_bytes(data: str, size: int, border: int) -> bytes:
+    """生成二维码PNG字节，size和border都会影响像素输出，需一并作为缓存键"""
+    buffer = io.BytesIO()
+    if segno is None:
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=size, border=border)
+        qr.add_data(data)
+        qr.make(fit=True)
+        qr.make_image(fill_color="black", back_color="white").save(buffer, format='PNG')
+        return buffer.getvalue()
+    # segno 直接用 zlib 写 PNG，不经过 PIL；make_qr 避免短数据生成 Micro QR
+    # boost_error=False 固定 L 级纠错，只按数据长度选最小版本，不再逐级试探；
+    # 二维码只有黑白两色，低压缩级别几乎不增大文件
+    qr = segno.make_qr(data, error='L', boost_error=False)
+    qr.save(buffer, kind='png', scale=size, border=border, compresslevel=1)
+    return buffer.getvalue()
 
 
 class QRCodeGenerator:
@@ -568,17 +909,8 @@ class QRCodeGenerator:
     def generate_qr_code(data: str, output_path: str, size: int = 10, border: int = 4) -> bool:
         """生成二维码"""
         try:
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=size,
-                border=border,
-            )
-            qr.add_data(data)
-            qr.make(fit=True)
-            
-            img = qr.make_image(fill_color="black", back_color="white")
-            img.save(output_path)
+            # 同一内容和尺寸的二维码PNG只生成一次，之后直接写出缓存的字节
+            VideoProcessor._write_file(output_path, _qr_png_bytes(data, size, border))
             return True
         except Exception as e:
             print(f"二维码生成失败: {str(e)}")
@@ -587,19 +919,20 @@ class QRCodeGenerator:
     @staticmethod
     async def generate_qr_code_async(data: str, output_path: str, size: int = 10, border: int = 4) -> bool:
         """异步生成二维码"""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, QRCodeGenerator.generate_qr_code, data, output_path, size, border)
+        if segno is None:
+            return await asyncio.to_thread(QRCodeGenerator.generate_qr_code, data, output_path, size, border)
+        # segno生成一个二维码约1毫秒，比线程池调度本身还快，直接在事件循环中执行
+        return QRCodeGenerator.generate_qr_code(data, output_path, size, border)
 
 
 if __name__ == "__main__":
     async def test_video_processing():
         """测试视频处理功能"""
-        processor = VideoProcessor()
-        
-        if await processor.check_ffmpeg():
-            print("FFmpeg可用，可以进行视频处理")
-        else:
-            print("FFmpeg不可用，请安装FFmpeg")
+        async with VideoProcessor() as processor:
+            if await processor.check_ffmpeg():
+                print("FFmpeg可用，可以进行视频处理")
+            else:
+                print("FFmpeg不可用，请安装FFmpeg")
         
         qr_generator = QRCodeGenerator()
         test_qr_path = "test_qr.png"
@@ -607,7 +940,5 @@ if __name__ == "__main__":
             print(f"二维码生成成功: {test_qr_path}")
         else:
             print("二维码生成失败")
-        
-        del processor
     
     asyncio.run(test_video_processing())
\ No newline at end of file
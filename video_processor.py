@@ -1,19 +1,36 @@
+import contextlib
+import functools
 import math
+import multiprocessing
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
-from moviepy import VideoFileClip, AudioFileClip, TextClip, CompositeVideoClip, concatenate_videoclips, concatenate_audioclips, ColorClip
+from moviepy import VideoFileClip, ImageClip, ImageSequenceClip, AudioFileClip, TextClip, CompositeVideoClip, concatenate_videoclips, ColorClip, afx
 
 from ajlog import logger
+from config import MAX_CONCURRENT_ENCODES, MP4_OUTPUT_ARGS, X264_PRESET
+from video_process import ProbeCache, VideoProcessor as FFmpegVideoProcessor, atomic_output
 
 try:
     import cv2
+
+    cv2.setUseOptimized(True)
 except ImportError:
     cv2 = None
     logger.warn("警告: cv2未安装，缩放效果将使用回退方案")
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 # 设置 MoviePy 配置以避免 ffmpeg 问题
 try:
     from moviepy.config import check_ffmpeg
@@ -23,34 +40,277 @@ except ImportError:
     logger.warn("无法导入 MoviePy 配置检查")
 
 
+STDERR_TAIL_BYTES = 64 * 1024
+
+
+def _run_ffmpeg(cmd, timeout):
+    """运行 FFmpeg，stdout 丢弃，stderr 边读边丢只保留最后 64 KiB，返回 (返回码, stderr 尾部文本)"""
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, bufsize=1 << 20)
+    tail = bytearray()
+
+    def drain():
+        for chunk in iter(lambda: proc.stderr.read1(STDERR_TAIL_BYTES), b''):
+            tail.extend(chunk)
+            del tail[:-STDERR_TAIL_BYTES]
+
+    reader = threading.Thread(target=drain, daemon=True)
+    reader.start()
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        reader.join()
+        proc.stderr.close()
+    # 只在需要时解码尾部，而不是整段输出
+    return returncode, tail.decode(errors='replace')
+
+
+def _aligned_empty(shape, dtype=np.uint8, align=32):
+    """分配起始地址按 align 字节对齐的数组，AVX2 加载不跨缓存行"""
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    buf = np.empty(nbytes + align, dtype=np.uint8)
+    offset = (-buf.ctypes.data) % align
+    return buf[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+def _zoom_matrices(scales, w, h):
+    """以画面中心缩放的 2x3 仿射矩阵，scales 为一维缩放比例数组，返回形状 (N, 2, 3)"""
+    scales = np.asarray(scales, dtype=np.float32)
+    matrices = np.zeros((len(scales), 2, 3), dtype=np.float32)
+    matrices[:, 0, 0] = scales
+    matrices[:, 1, 1] = scales
+    matrices[:, 0, 2] = (1 - scales) * w / 2
+    matrices[:, 1, 2] = (1 - scales) * h / 2
+    return matrices
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _zoom_fade(frame, scale, alpha_q8, out):
+        """
+        以画面中心放大并裁回原尺寸的双线性采样，同时乘以 8 位定点的淡入淡出 alpha，逐行并行，直接写入 out
+
+        缩放和淡入淡出在一次遍历中完成，不分配放大后的中间帧，也不再单独遍历一次做亮度缩放
+        """
+        h, w, channels = frame.shape
+        inv = 1.0 / scale
+        gain = alpha_q8 / 256.0
+        offset_y = h * 0.5 * (1.0 - inv)
+        offset_x = w * 0.5 * (1.0 - inv)
+        for y in numba.prange(h):
+            sy = y * inv + offset_y
+            y0 = min(int(sy), h - 1)
+            y1 = min(y0 + 1, h - 1)
+            fy = sy - y0
+            for x in range(w):
+                sx = x * inv + offset_x
+                x0 = min(int(sx), w - 1)
+                x1 = min(x0 + 1, w - 1)
+                fx = sx - x0
+                for c in range(channels):
+                    top = frame[y0, x0, c] * (1.0 - fx) + frame[y0, x1, c] * fx
+                    bottom = frame[y1, x0, c] * (1.0 - fx) + frame[y1, x1, c] * fx
+                    out[y, x, c] = np.uint8(min((top * (1.0 - fy) + bottom * fy) * gain + 0.5, 255.0))
+        return out
+
+    def _zoom_center_crop(frame, scale, out):
+        """以画面中心放大并裁回原尺寸，写入 out"""
+        return _zoom_fade(frame, scale, 256, out)
+
+    def _warm_zoom_kernel():
+        """用 8x8 的小帧触发一次编译，避免第一帧承担 JIT 延迟"""
+        frame = np.zeros((8, 8, 3), dtype=np.uint8)
+        _zoom_center_crop(frame, 1.02, np.empty_like(frame))
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _fade_apply(src, alpha_q8, out):
+        """uint8 帧乘以 8 位定点 alpha：(px * alpha_q8) >> 8，逐行并行写入 out"""
+        h, w, channels = src.shape
+        for y in numba.prange(h):
+            for x in range(w):
+                for c in range(channels):
+                    out[y, x, c] = (np.uint16(src[y, x, c]) * alpha_q8) >> 8
+        return out
+else:
+    _zoom_fade = None
+    _zoom_center_crop = None
+    _fade_apply = None
+
+
+@functools.lru_cache(maxsize=16)
+def _zoom_schedule(duration, fps, w, h):
+    """
+    按帧号预先计算缩放比例和仿射矩阵：从1.0到1.03再回到1.0，限制在[1.0, 1.05]
+
+    卡点片段的时长、帧率和尺寸都相同，结果按参数缓存，所有片段共用同一张表；返回的数组只读
+    """
+    frame_times = np.minimum(np.arange(int(np.ceil(duration * fps)) + 1) / fps, duration - 0.001)
+    scales = np.clip(1.0 + 0.03 * np.sin(2 * np.pi * frame_times / duration), 1.0, 1.05).astype(np.float32)
+    matrices = _zoom_matrices(scales, w, h)
+    scales.flags.writeable = False
+    matrices.flags.writeable = False
+    return scales, matrices
+
+
+def _warp_frame(frame, matrix, dst=None):
+    """对帧做一次 warpAffine，dst 为可复用的输出缓冲区；没有 cv2 时用 Numba 内核做中心缩放"""
+    if cv2 is None:
+        return _zoom_center_crop(frame, float(matrix[0, 0]), dst if dst is not None else np.empty_like(frame))
+    size = (frame.shape[1], frame.shape[0])
+    if dst is not None:
+        return cv2.warpAffine(frame, matrix, size, dst=dst, flags=cv2.INTER_LINEAR)
+    return cv2.warpAffine(frame, matrix, size, flags=cv2.INTER_LINEAR)
+
+
+def _center_zoom(frame, scale, dst=None):
+    """以画面中心放大帧：缩放和平移合并为一次 warpAffine，不再分配放大后的中间帧再裁剪"""
+    h, w = frame.shape[:2]
+    return _warp_frame(frame, _zoom_matrices([scale], w, h)[0], dst)
+
+
+def _scale_frame(frame, alpha, dst=None):
+    """按 alpha 缩放帧亮度，结果保持 uint8，不经过 float64 中间数组；dst 为可复用的输出缓冲区"""
+    if cv2 is not None:
+        if dst is not None:
+            return cv2.convertScaleAbs(frame, dst=dst, alpha=alpha)
+        return cv2.convertScaleAbs(frame, alpha=alpha)
+    if dst is None:
+        dst = np.empty_like(frame)
+    if _fade_apply is not None:
+        return _fade_apply(frame, int(alpha * 256), dst)
+    return np.multiply(frame, np.float32(alpha), out=dst, casting='unsafe')
+
+
 class VideoProcessor:
     """
     基于MoviePy 2.x的视频处理类
     实现卡点动画、转场效果和时间进度显示
     """
 
+    # 中间文件随后还会被 FFmpeg 解码并重新编码，画质无关，只追求编解码速度
+    INTERMEDIATE_WRITE_OPTS = {
+        'codec': 'libx264',
+        'preset': 'ultrafast',
+        'ffmpeg_params': ['-tune', 'zerolatency,fastdecode', '-crf', '23', '-g', '60', '-pix_fmt', 'yuv420p'],
+    }
+    # 成片的视频流，使用成片的编码预设（默认 veryfast，可通过 X264_PRESET 配置）
+    TEMP_WRITE_OPTS = {
+        'codec': 'libx264',
+        'preset': X264_PRESET,
+        'ffmpeg_params': ['-crf', '23', '-pix_fmt', 'yuv420p'],
+    }
+    # 硬件编码器的 write_videofile 参数，进程内所有实例共享；空字典表示没有可用的硬件编码器
+    _hw_write_opts = None
+    # ffmpeg -version 的检查结果，每个进程只检查一次；后台任务运行在进程池中，各进程各有一份，
+    # 并行渲染的 spawn 子进程由 _init_worker 直接沿用父进程的结果；锁只防同一进程内多线程重复检查
+    _ffmpeg_ok = None
+    _ffmpeg_check_lock = threading.Lock()
+    # ffprobe 的路径，首次探测时长时由 ffmpeg 的路径推出，进程内只解析一次
+    _ffprobe = None
+    # ffprobe 得到的视频时长，以(绝对路径, 修改时间, 文件大小)为键，所有实例共享
+    duration_cache = ProbeCache()
+    # 每个实例最多保持打开的源视频数，超出时关闭最久未用的
+    MAX_OPEN_VIDEOS = 8
+
     def __init__(self):
         self.output_size = (1280, 720)  # 输出视频尺寸
         self.transition_duration = 0.3  # 转场时长
         self.beat_frame_duration = 0.7  # 每个卡点帧显示时长
         self.fade_duration = 0.1  # 淡入淡出时长（秒）
+        self.output_fps = 30  # FFmpeg 渲染时统一的帧率，xfade/concat 要求各段帧率一致
+        self._ffmpeg = shutil.which('ffmpeg') or 'ffmpeg'  # 解析一次绝对路径，之后调用不再查 PATH
+        self._open_videos = OrderedDict()  # 已打开的源视频，见 _open_video
         self._check_ffmpeg_availability()
+        if cv2 is None and _zoom_center_crop is not None:
+            _warm_zoom_kernel()
+        self._hw_encoder = self._detect_hw_encoder()
+
+    def close(self):
+        """关闭本实例缓存的所有源视频"""
+        while self._open_videos:
+            _, clip = self._open_videos.popitem(last=False)
+            try:
+                clip.close()
+            except Exception as e:
+                print(f"关闭视频时出错: {e}")
+
+    def __del__(self):
+        # 处理器被释放（如 app.py 中 del processor）时关闭缓存的源视频，不遗留 FFmpeg 读取进程
+        if getattr(self, '_open_videos', None):
+            self.close()
 
     def _check_ffmpeg_availability(self):
-        """检查 ffmpeg 是否可用"""
+        """检查 ffmpeg 是否可用，结果在进程内缓存（子类共用），重复创建实例不再启动子进程"""
+        if VideoProcessor._ffmpeg_ok is not None:
+            return VideoProcessor._ffmpeg_ok
+        with VideoProcessor._ffmpeg_check_lock:
+            if VideoProcessor._ffmpeg_ok is not None:
+                return VideoProcessor._ffmpeg_ok
+            try:
+                if not os.path.isabs(self._ffmpeg):
+                    # PATH 中找不到 ffmpeg 时无需启动子进程确认
+                    raise FileNotFoundError("PATH 中没有 ffmpeg")
+                returncode, _ = _run_ffmpeg([self._ffmpeg, '-version'], timeout=5)
+                if returncode == 0:
+                    logger.info("✓ FFmpeg 可用")
+                    VideoProcessor._ffmpeg_ok = True
+                else:
+                    logger.warn("⚠ FFmpeg 不可用 - 可能会遇到视频处理问题")
+                    VideoProcessor._ffmpeg_ok = False
+            except Exception as e:
+                logger.warn(f"⚠ 无法检查 FFmpeg: {e}")
+                logger.warn("如果遇到视频处理问题，请确保已安装 FFmpeg")
+                VideoProcessor._ffmpeg_ok = False
+        return VideoProcessor._ffmpeg_ok
+
+    def _detect_hw_encoder(self):
+        """探测一次可用的硬件编码器（NVENC/QSV/VAAPI/VideoToolbox/AMF），实际编码一帧确认驱动可用；ffmpeg 不可用时直接跳过"""
+        if VideoProcessor._hw_write_opts is not None:
+            return VideoProcessor._hw_write_opts
+        if VideoProcessor._ffmpeg_ok is False:
+            VideoProcessor._hw_write_opts = {}
+            return VideoProcessor._hw_write_opts
+        picked = {}
         try:
-            result = subprocess.run(['ffmpeg', '-version'],
-                                    capture_output=True, text=True, timeout=5)
+            encoders = subprocess.run([self._ffmpeg, '-hide_banner', '-encoders'],
+                                      capture_output=True, text=True, timeout=10).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            encoders = ''
+        for opts in FFmpegVideoProcessor.HW_ENCODER_OPTS:
+            if opts['codec'] not in encoders:
+                continue
+            try:
+                result = subprocess.run(
+                    [self._ffmpeg, '-hide_banner', '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+                     '-frames:v', '1', *FFmpegVideoProcessor._vcodec_args(opts), '-f', 'null', '-'],
+                    capture_output=True, timeout=30)
+            except (OSError, subprocess.TimeoutExpired):
+                continue
             if result.returncode == 0:
-                logger.info("✓ FFmpeg 可用")
-                return True
-            else:
-                logger.warn("⚠ FFmpeg 不可用 - 可能会遇到视频处理问题")
-                return False
-        except Exception as e:
-            logger.warn(f"⚠ 无法检查 FFmpeg: {e}")
-            logger.warn("如果遇到视频处理问题，请确保已安装 FFmpeg")
-            return False
+                params = list(opts['ffmpeg_params'])
+                if opts.get('hw_upload'):
+                    params += ['-vf', opts['hw_upload']]
+                picked = {'codec': opts['codec'], 'ffmpeg_params': params}
+                if opts['preset']:
+                    picked['preset'] = opts['preset']
+                logger.info(f"✓ 使用硬件编码器: {opts['codec']}")
+                break
+        VideoProcessor._hw_write_opts = picked
+        return VideoProcessor._hw_write_opts
+
+    def _write_videofile(self, clip, path, opts, threads=None):
+        """写出无音频视频，有硬件编码器时优先使用，硬件编码失败时按 opts 用 libx264 重试；threads 默认使用全部核心"""
+        threads = threads or os.cpu_count()
+        if self._hw_encoder:
+            try:
+                clip.write_videofile(path, logger=None, audio=False, **self._hw_encoder)
+                return
+            except Exception as e:
+                logger.warn(f"硬件编码 {self._hw_encoder['codec']} 失败，改用 libx264: {e}")
+        clip.write_videofile(path, logger=None, audio=False, threads=threads, **opts)
 
     def create_pip_video(self, main_video_path, pip_video_path, output_path, text=None, text_font_size=16, text_position=(0, 0), pip_position='top-right', pip_scale=0.25):
         """
@@ -68,8 +328,9 @@ class VideoProcessor:
         """
         try:
             # 加载主视频和画中画视频
-            main_video = VideoFileClip(main_video_path).resized(self.output_size)
-            pip_video = VideoFileClip(pip_video_path).resized(self.output_size)
+            # 由 FFmpeg 在解码时直接缩放到输出尺寸，避免解码后再逐帧缩放
+            main_video = self._open_video(main_video_path)
+            pip_video = self._open_video(pip_video_path)
 
             # 创建画中画效果
             pip_clip = self.create_picture_in_picture(
@@ -90,10 +351,7 @@ class VideoProcessor:
                 )
                 
                 # 设置持续时间
-                if hasattr(text_clip, 'with_duration'):
-                    text_clip = text_clip.with_duration(pip_clip.duration)
-                else:
-                    text_clip = text_clip.set_duration(pip_clip.duration)
+                text_clip = text_clip.with_duration(pip_clip.duration)
                 
                 # 创建文本背景
                 padding = 10  # 背景边距
@@ -112,27 +370,19 @@ class VideoProcessor:
                 text_with_bg = CompositeVideoClip([text_bg, text_clip])
                 
                 # 设置整个文本+背景的位置
-                if hasattr(text_with_bg, 'with_position'):
-                    text_with_bg = text_with_bg.with_position(text_position)
-                else:
-                    text_with_bg = text_with_bg.set_position(text_position)
+                text_with_bg = text_with_bg.with_position(text_position)
                 
                 final_clip = CompositeVideoClip([pip_clip, text_with_bg])
             else:
                 final_clip = pip_clip
 
 
-            # 保存最终视频
-            temp_output_path = output_path.replace(".mp4", "_temp.mp4")
-            final_clip.write_videofile(temp_output_path, logger=None)
-
-            success = self._add_music_with_ffmpeg(temp_output_path, output_path, "bgm_mbz.mp3")
+            # 保存最终视频：帧直接通过管道交给 FFmpeg，编码时一并混入背景音乐
+            self._pipe_to_ffmpeg(final_clip, output_path, self._resolve_music_path("bgm_mbz.mp3"))
 
             logger.info(f"视频处理完成，保存至: {output_path}")
 
-            # 清理资源
-            main_video.close()
-            pip_video.close()
+            # 清理资源（源视频由 _open_video 缓存，随处理器一起关闭）
             final_clip.close()
 
         except Exception as e:
@@ -153,173 +403,460 @@ class VideoProcessor:
         - output_path: 输出文件路径
         - speed_factor: 第二个视频的播放速度倍数
         - font_size: 时间显示字体大小
-        - background_music_path: 背景音乐文件路径（可选，默认使用jiggy boogy.mp3）
+        - background_music_path: 背景音乐文件路径（可选，默认使用jiggy boogy.mp3，传 False 表示不加音乐）
         """
+        # 只确定一次音乐文件；没有音乐时两条渲染路径都直接输出无音轨视频，不做任何混音步骤
+        music_path = self._resolve_music_path(background_music_path)
+
+        # 优先用单条 FFmpeg filter_complex 渲染，失败时回退到 MoviePy 逐帧合成
         try:
-            # 加载视频
-            video1 = VideoFileClip(video1_path).resized(self.output_size)
-            video2 = VideoFileClip(video2_path).resized(self.output_size)
-
-            min_duration = min(video1.duration, video2.duration)
-
-            # 创建卡点片段
-            beat_clips = self._create_beat_clips(video1, beat_times)
-
-            left_duration = min_duration - beat_times[-1]
-            seg_duration = int(left_duration / 4)
-            main_clips = []
-            for i in range(0, 4):
-                if i % 2 == 0:
-                    v_main = video2.subclipped(beat_times[-1] + i * seg_duration, beat_times[-1] + (i + 1) * seg_duration)
-                    v_pip = video1.subclipped(beat_times[-1] + i * seg_duration, beat_times[-1] + (i + 1) * seg_duration)
-                else:
-                    v_main = video1.subclipped(beat_times[-1] + i * seg_duration, beat_times[-1] + (i + 1) * seg_duration)
-                    v_pip = video2.subclipped(beat_times[-1] + i * seg_duration, beat_times[-1] + (i + 1) * seg_duration)
-
-                pip_result = self.create_picture_in_picture(
-                    main_clip=v_main,
-                    pip_clip=v_pip,
-                    pip_position='top-right',
-                    pip_scale=0.25,
-                    pip_start_time=0,
-                    pip_duration=3
-                )
+            self._create_beat_video_ffmpeg(video1_path, video2_path, beat_times,
+                                           output_path, music_path)
+            logger.info(f"视频处理完成，保存至: {output_path}")
+            return
+        except Exception as ffmpeg_error:
+            logger.warn(f"FFmpeg 渲染卡点视频失败，回退到 MoviePy: {ffmpeg_error}")
 
-                main_clips.append(pip_result)
+        try:
+            # 每个对象只登记一次，退出时（包括异常）按相反顺序各关闭一次，临时目录也只删除一次
+            with contextlib.ExitStack() as cleanup:
+                # 加载视频（源视频由 _open_video 缓存，随处理器一起关闭）
+                video1 = self._open_video(video1_path)
+                video2 = self._open_video(video2_path)
+
+                min_duration = min(video1.duration, video2.duration)
+
+                left_duration = min_duration - beat_times[-1]
+                seg_duration = int(left_duration / 4)
+                segment_ranges = [(beat_times[-1] + i * seg_duration, beat_times[-1] + (i + 1) * seg_duration)
+                                  for i in range(0, 4)]
+                work_dir = tempfile.mkdtemp(prefix='beat_')
+                cleanup.callback(shutil.rmtree, work_dir, ignore_errors=True)
+                v_diy, segment_clips = self._build_body(video1_path, video2_path, video1, video2,
+                                                        segment_ranges, work_dir)
+                for clip in segment_clips:
+                    cleanup.callback(_close_quietly, clip)
+                # FFmpeg 渲染主体时 v_diy 就是唯一的片段，已登记过
+                if not any(clip is v_diy for clip in segment_clips):
+                    cleanup.callback(_close_quietly, v_diy)
+                #
+                # # 创建带时间显示的第二个视频
+                # video2_with_timer = self._add_timer_to_video(video2, speed_factor, font_size)
+
+                # 卡点片段多进程并行渲染后与主体拼接，失败时单进程组合；两种方式都在同一次编码中混入背景音乐
+                logger.info("写入视频...")
+                try:
+                    self._render_combined_parallel(video1_path, beat_times, v_diy, output_path, work_dir, music_path)
+                except Exception as parallel_error:
+                    logger.warn(f"并行渲染卡点片段失败，改为单进程组合: {parallel_error}")
+                    beat_clips = self._create_beat_clips(video1, beat_times)
+                    final_video = self._combine_clips(beat_clips, v_diy)
+                    cleanup.callback(_close_quietly, final_video)
+                    self._pipe_to_ffmpeg(final_video, output_path, music_path)
+                logger.info("视频写入成功!")
 
-            v_end = self.create_text_video_clip("A Touch of Culture, A Handful of Heart", 3, output_size=video1.size)
-            main_clips.append(v_end)
-            fade_duration = 1
-            transition_clip = ColorClip(size=self.output_size, color=(0, 0, 0), duration=1)
-            v_diy = concatenate_videoclips(main_clips, method='compose', transition=transition_clip, bg_color=(0, 0, 0), padding=-fade_duration)
-            #
-            # # 创建带时间显示的第二个视频
-            # video2_with_timer = self._add_timer_to_video(video2, speed_factor, font_size)
+            logger.info(f"视频处理完成，保存至: {output_path}")
 
-            # 组合所有片段
-            final_video = self._combine_clips(beat_clips, v_diy)
+        except Exception as e:
+            print(f"视频处理出错: {str(e)}")
+            raise
 
-            # 先保存没有音频的视频
-            temp_video_path = output_path.replace('.mp4', '_temp_no_audio.mp4')
-            try:
-                logger.info("写入临时视频（无音频）...")
-                final_video.write_videofile(
-                    temp_video_path,
-                    logger=None,
-                    audio=False  # 明确禁用音频
-                )
-                logger.info("临时视频写入成功!")
-            except Exception as write_error:
-                logger.error(f"临时视频写入失败: {write_error}")
-                raise
+    def _fit(self, clip):
+        """尺寸已是输出尺寸时原样返回，否则缩放到输出尺寸；避免对已对齐的片段逐帧做一次无用的缩放"""
+        if tuple(clip.size) == tuple(self.output_size):
+            return clip
+        return clip.resized(self.output_size)
 
-            # 使用 FFmpeg 添加背景音乐
-            success = self._add_music_with_ffmpeg(temp_video_path, output_path, background_music_path)
+    def _open_video(self, video_path, cache=True):
+        """
+        加载视频，由 FFmpeg 在解码时直接缩放到输出尺寸（MoviePy 2.x 的 target_resolution 为 (宽, 高)）
 
-            # 清理临时文件
-            try:
-                if os.path.exists(temp_video_path):
-                    os.remove(temp_video_path)
-            except:
-                pass
+        cache 为 True 时按(绝对路径, 修改时间, 文件大小)复用本实例已打开的视频，省去重复启动读取进程和解析容器，
+        返回的视频由 close() 统一关闭，调用方不要单独关闭；临时文件传 cache=False，由调用方自行关闭
+        """
+        if not cache:
+            return VideoFileClip(video_path, target_resolution=self.output_size,
+                                 resize_algorithm='bilinear')
+        key = ProbeCache.key(video_path)
+        clip = self._open_videos.get(key)
+        if clip is not None:
+            self._open_videos.move_to_end(key)
+            return clip
+        clip = VideoFileClip(video_path, target_resolution=self.output_size,
+                             resize_algorithm='bilinear')
+        self._open_videos[key] = clip
+        while len(self._open_videos) > self.MAX_OPEN_VIDEOS:
+            self._open_videos.popitem(last=False)[1].close()
+        return clip
+
+    def _ffprobe_path(self):
+        """返回 ffprobe 路径：优先使用与已解析的 ffmpeg 同目录的 ffprobe，其次在 PATH 中查找"""
+        if VideoProcessor._ffprobe is None:
+            sibling = os.path.join(os.path.dirname(self._ffmpeg), 'ffprobe')
+            if os.path.isabs(self._ffmpeg) and os.access(sibling, os.X_OK):
+                VideoProcessor._ffprobe = sibling
+            else:
+                VideoProcessor._ffprobe = shutil.which('ffprobe') or 'ffprobe'
+        return VideoProcessor._ffprobe
+
+    def _probe_duration(self, video_path):
+        """使用 ffprobe 获取视频时长（秒），同一文件只探测一次"""
+        key = ProbeCache.key(video_path)
+        probe = self.duration_cache.get(key)
+        if probe is not None:
+            return probe['duration']
+        result = subprocess.run(
+            [self._ffprobe_path(), '-v', 'error', '-show_entries', 'format=duration',
+             '-of', 'default=noprint_wrappers=1:nokey=1', video_path],
+            capture_output=True, text=True, timeout=30)
+        if result.returncode != 0:
+            raise Exception(f"获取视频时长失败: {result.stderr.strip()}")
+        duration = float(result.stdout.strip())
+        self.duration_cache.put(key, {'duration': duration})
+        return duration
+
+    def _build_beat_video_command(self, video1_path, video2_path, beat_times,
+                                  output_path, music_path, end_text_path, hw=False):
+        """
+        构建卡点视频的单条 FFmpeg 命令，hw 为 True 时使用探测到的硬件编码器
+
+        与 MoviePy 路径的画面一致：卡点片段（缩放 + 淡入淡出）、主体四段画中画
+        （fadeblack 转场）、结尾文字，全部在 filter_complex 中完成，
+        解码、缩放、叠加和编码都由 FFmpeg 原生完成，不再逐帧经过 Python
+        """
+        width, height = self.output_size
+        fps = self.output_fps
+        fade = self.fade_duration
+        duration1 = self._probe_duration(video1_path)
+        min_duration = min(duration1, self._probe_duration(video2_path))
+        normalize = f"scale={width}:{height},setsar=1,fps={fps},format=yuv420p"
+
+        inputs = []
+        filters = []
+
+        def add_input(path, start, length):
+            # 输入端 -ss/-t 只解码需要的区间，每个片段一个独立输入
+            inputs.extend(['-ss', f'{start:.3f}', '-t', f'{length:.3f}', '-i', path])
+            return len(inputs) // 6 - 1
+
+        # 卡点片段：只解码卡点处的一帧，由 zoompan 把这一帧展开成整段显示时长；
+        # 第一个之外都加 1.0 -> 1.03 -> 1.0 的缩放，每段淡入淡出
+        beat_labels = []
+        zoom_frames = max(1, round(self.beat_frame_duration * fps))
+        clip_duration = zoom_frames / fps
+        for i, beat_time in enumerate(beat_times):
+            if beat_time >= duration1:
+                logger.info(f"警告: 卡点时间 {beat_time}s 超出视频长度 {duration1}s")
+                continue
+            index = add_input(video1_path, beat_time, min(0.5, duration1 - beat_time))
+            zoom = f"max(1,1+0.03*sin(2*PI*on/{zoom_frames}))" if i > 0 else "1"
+            chain = (f"[{index}:v]trim=end_frame=1,scale={width}:{height},setsar=1,format=yuv420p"
+                     f",zoompan=z='{zoom}':d={zoom_frames}"
+                     f":x='iw/2-iw/zoom/2':y='ih/2-ih/zoom/2':s={width}x{height}:fps={fps}")
+            chain += f",fade=t=in:st=0:d={fade},fade=t=out:st={max(0, clip_duration - fade):.3f}:d={fade}"
+            filters.append(f"{chain}[b{i}]")
+            beat_labels.append(f"b{i}")
+
+        # 主体：最后一个卡点之后分四段，主画面/画中画在两个视频间交替，画中画只显示前3秒
+        last_beat = beat_times[-1]
+        seg_duration = int((min_duration - last_beat) / 4)
+        transition = 1
+        if seg_duration <= transition:
+            raise Exception(f"主体片段过短: {seg_duration}s")
+        pip_width, pip_height = int(width * 0.25), int(height * 0.25)
+        margin = 20
+        segments = []
+        for i in range(4):
+            start_time = last_beat + i * seg_duration
+            main_path, pip_path = (video2_path, video1_path) if i % 2 == 0 else (video1_path, video2_path)
+            main_index = add_input(main_path, start_time, seg_duration)
+            pip_index = add_input(pip_path, start_time, min(3, seg_duration))
+            filters.append(f"[{main_index}:v]{normalize}[m{i}]")
+            filters.append(f"[{pip_index}:v]scale={pip_width}:{pip_height},setsar=1,fps={fps},format=yuv420p[p{i}]")
+            filters.append(f"[m{i}][p{i}]overlay=x=W-w-{margin}:y={margin}:eof_action=pass[s{i}]")
+            segments.append((f"s{i}", seg_duration))
+
+        # 结尾文字，各段之间 1 秒黑场转场
+        body_filters, current = self._body_filters(segments, end_text_path, transition)
+        filters += body_filters
+        filters.append(f"[{current}]fade=t=in:st=0:d={fade}[diy]")
+
+        concat_inputs = ''.join(f"[{label}]" for label in beat_labels + ['diy'])
+        filters.append(f"{concat_inputs}concat=n={len(beat_labels) + 1}:v=1:a=0"
+                       f"{self._hw_upload_filter(hw)}[outv]")
+
+        cmd = [self._ffmpeg, '-y', *inputs]
+        if music_path:
+            # 音乐较短时由 FFmpeg 循环输入，-shortest 按视频长度截断
+            cmd += ['-stream_loop', '-1', '-i', music_path]
+        cmd += ['-filter_complex', ';'.join(filters), '-map', '[outv]',
+                *self._output_args(len(inputs) // 6 if music_path else None, hw, filtered=True), output_path]
+        return cmd
+
+    def _pip_segment(self, main_video, pip_video, start, end):
+        """截取主体的一段并叠加右上角画中画，画中画只显示前3秒"""
+        return self.create_picture_in_picture(
+            main_clip=main_video.subclipped(start, end),
+            pip_clip=pip_video.subclipped(start, end),
+            pip_position='top-right',
+            pip_scale=0.25,
+            pip_start_time=0,
+            pip_duration=3
+        )
+
+    def _build_body(self, video1_path, video2_path, video1, video2, ranges, work_dir):
+        """
+        合成主体：各段画中画、结尾文字，段与段之间 1 秒黑场转场，返回 (主体片段, 用完后需关闭的片段列表)
 
-            if not success:
-                # 如果音频添加失败，至少我们有无音频的视频
-                print("音频添加失败，保留无音频版本")
-                if os.path.exists(temp_video_path):
-                    os.rename(temp_video_path, output_path)
+        画中画片段在多个进程中并行写出后，由 FFmpeg 的 xfade 直接拼成主体文件，不再经过
+        concatenate_videoclips 逐帧合成；任一步失败时退回 MoviePy 拼接
+        """
+        try:
+            segment_paths = self._render_pip_segments_parallel(video1_path, video2_path, ranges, work_dir)
+        except Exception as e:
+            logger.warn(f"并行合成画中画片段失败，改为单进程: {e}")
+            segment_paths = None
 
-            # 清理资源
+        if segment_paths:
             try:
-                video1.close()
-                video2.close()
-                final_video.close()
-            except Exception as cleanup_error:
-                print(f"清理资源时出错: {cleanup_error}")
+                body = self._open_video(self._render_body_ffmpeg(segment_paths, work_dir), cache=False)
+                return body, [body]
+            except Exception as e:
+                logger.warn(f"FFmpeg 拼接主体失败，改用 MoviePy: {e}")
+            main_clips = [self._open_video(path, cache=False) for path in segment_paths]
+            segment_clips = list(main_clips)
+        else:
+            main_clips = [self._pip_segment(*((video2, video1) if i % 2 == 0 else (video1, video2)), start, end)
+                          for i, (start, end) in enumerate(ranges)]
+            segment_clips = []
+
+        v_end = self.create_text_video_clip("A Touch of Culture, A Handful of Heart", 3, output_size=video1.size)
+        main_clips.append(v_end)
+        fade_duration = 1
+        transition_clip = ColorClip(size=self.output_size, color=(0, 0, 0), duration=1)
+        v_diy = concatenate_videoclips(main_clips, method='compose', transition=transition_clip, bg_color=(0, 0, 0), padding=-fade_duration)
+        return v_diy, segment_clips
+
+    def _render_pip_segments_parallel(self, video1_path, video2_path, ranges, work_dir):
+        """
+        主体的各段画中画互不依赖，在多个进程中并行合成并写出，返回按顺序排列的片段文件
 
-            logger.info(f"视频处理完成，保存至: {output_path}")
+        偶数段以第二个视频为主画面，奇数段相反
+        """
+        count = len(ranges)
+        # 与卡点片段共用同一份按任务分配的核心预算，避免嵌套进程池超额订阅
+        workers, threads = self._process_budget(count)
+        return self._map_in_processes(_build_pip_segment, [video1_path] * count, [video2_path] * count,
+                                      [start for start, _ in ranges], [end for _, end in ranges],
+                                      range(count), [work_dir] * count,
+                                      workers=workers, threads=threads)
+
+    def _render_body_ffmpeg(self, segment_paths, work_dir):
+        """用 FFmpeg 给画中画片段文件加上结尾文字和黑场转场，写成主体文件并返回路径"""
+        width, height = self.output_size
+        normalize = f"scale={width}:{height},setsar=1,fps={self.output_fps},format=yuv420p"
+        end_text_path = os.path.join(work_dir, 'body_end.txt')
+        with open(end_text_path, 'w', encoding='utf-8') as f:
+            f.write("A Touch of Culture, A Handful of Heart")
+
+        inputs = []
+        filters = []
+        segments = []
+        for i, path in enumerate(segment_paths):
+            inputs += ['-i', path]
+            filters.append(f"[{i}:v]{normalize}[s{i}]")
+            segments.append((f"s{i}", self._probe_duration(path)))
+        body_filters, label = self._body_filters(segments, end_text_path)
+        filters += body_filters
+
+        body_path = os.path.join(work_dir, 'body.mp4')
+        opts = self.INTERMEDIATE_WRITE_OPTS
+        cmd = [self._ffmpeg, '-y', *inputs, '-filter_complex', ';'.join(filters), '-map', f'[{label}]',
+               '-c:v', opts['codec'], '-preset', opts['preset'], *opts['ffmpeg_params'], body_path]
+        logger.debug(f"FFmpeg 命令: {' '.join(cmd)}")
+        returncode, stderr = _run_ffmpeg(cmd, timeout=1800)
+        if returncode != 0:
+            raise Exception(f"FFmpeg 拼接主体失败: {stderr[-2000:]}")
+        return body_path
+
+    def _body_filters(self, segments, end_text_path, transition=1):
+        """
+        主体结尾文字与各段之间黑场转场的滤镜，segments 为 [(标签, 时长)]，返回 (滤镜列表, 输出标签)
 
-        except Exception as e:
-            print(e)
-            print(f"视频处理出错: {str(e)}")
-            # 确保在出错时也能清理资源
-            try:
-                if 'video1' in locals():
-                    video1.close()
-                if 'video2' in locals():
-                    video2.close()
-                if 'final_video' in locals():
-                    final_video.close()
-            except:
-                pass
-            raise
+        各段之间 transition 秒 fadeblack 转场，总时长与 MoviePy 的 padding=-1 拼接一致
+        """
+        width, height = self.output_size
+        fps = self.output_fps
+        end_duration = 3
+        filters = [f"color=c=black:s={width}x{height}:r={fps}:d={end_duration},format=yuv420p,"
+                   f"drawtext=textfile='{end_text_path}':font=Arial:fontsize=60:fontcolor=white"
+                   f":x=(w-tw)/2:y=(h-th)/2[end]"]
+        segments = list(segments) + [("end", end_duration)]
+
+        current, current_duration = segments[0]
+        for k, (label, length) in enumerate(segments[1:], 1):
+            filters.append(f"[{current}][{label}]xfade=transition=fadeblack:duration={transition}"
+                           f":offset={current_duration - transition:.3f}[x{k}]")
+            current, current_duration = f"x{k}", current_duration + length - transition
+        return filters, current
+
+    def _create_beat_video_ffmpeg(self, video1_path, video2_path, beat_times,
+                                  output_path, music_path=None):
+        """使用单条 FFmpeg 命令渲染卡点视频并混入背景音乐，music_path 为已确认存在的文件，None 表示不加音乐"""
+        work_dir = tempfile.mkdtemp(prefix='beat_')
+        try:
+            # 结尾文字写入文件，避免 filter_complex 中的逗号、引号转义问题
+            end_text_path = os.path.join(work_dir, 'end.txt')
+            with open(end_text_path, 'w', encoding='utf-8') as f:
+                f.write("A Touch of Culture, A Handful of Heart")
+
+            with atomic_output(output_path) as temp_path:
+                # 有硬件编码器时先用硬件编码，失败后用 libx264 重试
+                for hw in self._encoder_attempts():
+                    cmd = self._build_beat_video_command(video1_path, video2_path, beat_times,
+                                                         temp_path, music_path, end_text_path, hw)
+                    logger.debug(f"FFmpeg 命令: {' '.join(cmd)}")
+                    returncode, stderr = _run_ffmpeg(cmd, timeout=1800)
+                    if returncode == 0:
+                        break
+                    logger.warn(f"FFmpeg 渲染失败: {stderr[-2000:]}")
+                else:
+                    raise Exception(f"FFmpeg 错误: {stderr[-2000:]}")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _create_beat_clips(self, video, beat_times, first_index=0, bake=False):
+        """
+        创建卡点片段 - 修复版本，first_index 为 beat_times[0] 在全部卡点中的序号
 
-    def _create_beat_clips(self, video, beat_times):
-        """创建卡点片段 - 修复版本"""
+        bake 为 True 时每个片段的帧一次批量算好（见 _add_zoom_and_fade），用于随即逐个写出的子进程
+        """
         beat_clips = []
 
-        for i, beat_time in enumerate(beat_times):
+        beats = []
+        for i, beat_time in enumerate(beat_times, first_index):
             # 确保时间在视频范围内
             if beat_time >= video.duration:
                 logger.info(f"警告: 卡点时间 {beat_time}s 超出视频长度 {video.duration}s")
                 continue
+            beats.append((i, beat_time))
 
-            # 确保截取的片段长度与显示时长一致，避免黑帧
-            clip_duration = self.beat_frame_duration  # 使用统一的持续时间
-            start_time = max(0, beat_time - 0.05)  # 减少提前时间，更精确对齐卡点
-            end_time = min(video.duration, start_time + clip_duration)
-
-            # 确保片段长度足够
-            if end_time - start_time < self.beat_frame_duration:
-                # 如果到视频末尾长度不够，向前调整起始时间
-                start_time = max(0, end_time - self.beat_frame_duration)
-                logger.info(f"调整卡点 {i + 1} 时间范围: {start_time:.2f}s - {end_time:.2f}s")
-
-            try:
-                frame_clip = video.subclipped(start_time, end_time)
-            except AttributeError:
-                try:
-                    frame_clip = video.subclip(start_time, end_time)
-                except AttributeError:
-                    logger.warn(f"错误: 无法截取视频片段，跳过卡点 {beat_time}s")
-                    continue
+        # 每个卡点只解码一帧静止显示，缩放效果按时间作用在这一帧上；所有卡点帧一次读入同一块缓冲区
+        keyframes, loaded = self._read_keyframes(video, [beat_time for _, beat_time in beats])
 
-            # 强制调整到统一尺寸
-            try:
-                frame_clip = frame_clip.resized(self.output_size)
-            except AttributeError:
-                try:
-                    frame_clip = frame_clip.resize(self.output_size)
-                except:
-                    print(f"警告: 无法调整卡点片段尺寸")
-
-            # 验证片段持续时间，只有在需要时才调整
-            actual_duration = frame_clip.duration
-            if abs(actual_duration - self.beat_frame_duration) > 0.01:  # 允许小的误差
-                try:
-                    frame_clip = frame_clip.with_duration(self.beat_frame_duration)
-                    logger.info(f"调整卡点 {i + 1} 持续时间: {actual_duration:.2f}s -> {self.beat_frame_duration}s")
-                except AttributeError:
-                    try:
-                        frame_clip = frame_clip.set_duration(self.beat_frame_duration)
-                        print(f"调整卡点 {i + 1} 持续时间: {actual_duration:.2f}s -> {self.beat_frame_duration}s")
-                    except:
-                        print(f"警告: 无法设置卡点片段持续时间，使用原始时长: {actual_duration:.2f}s")
+        for (i, beat_time), frame, ok in zip(beats, keyframes, loaded):
+            if not ok:
+                logger.warn(f"错误: 无法读取卡点帧，跳过卡点 {beat_time}s")
+                continue
+            # 片段就是这一帧，直接检查是否为纯黑帧
+            if frame.mean() <= 5:
+                logger.warn(f"警告: 卡点 {beat_time}s 可能是黑帧，跳过")
+                continue
+            frame_clip = ImageClip(frame).with_duration(self.beat_frame_duration).with_fps(video.fps)
 
-            # 添加改进的缩放效果作为转场
-            if i > 0:  # 重新启用优化后的缩放效果
-                frame_clip = self._add_simple_zoom_effect(frame_clip)
+            # 第一个之外加缩放效果作为转场，与淡入淡出合并为一次逐帧变换
+            frame_clip = self._add_zoom_and_fade(frame_clip, self.fade_duration, zoom=i > 0, bake=bake)
 
             beat_clips.append(frame_clip)
             logger.info(f"成功创建卡点 {i + 1}: {beat_time}s, 显示时长: {self.beat_frame_duration}s")
 
         return beat_clips
 
+    def _read_keyframes(self, video, times):
+        """
+        把各时间点的帧读入一块预分配的 (N, 高, 宽, 3) uint8 缓冲区，返回缓冲区和每帧是否读取成功
+
+        按时间递增的顺序读取，读取器只向前顺序解码，不会为乱序的卡点来回 seek；
+        各卡点片段直接引用缓冲区中的视图，不再各自持有一份帧拷贝
+        """
+        width, height = video.size
+        keyframes = np.empty((len(times), height, width, 3), dtype=np.uint8)
+        loaded = [False] * len(times)
+        for k in sorted(range(len(times)), key=times.__getitem__):
+            try:
+                frame = video.get_frame(times[k])
+                keyframes[k] = frame[:, :, :3]
+                loaded[k] = True
+            except Exception as e:
+                logger.warn(f"读取卡点帧失败 {times[k]}s: {e}")
+        return keyframes, loaded
+
+    def _add_zoom_and_fade(self, clip, fade_duration, zoom=True, bake=False):
+        """
+        缩放与淡入淡出合并为一次 transform：每帧只经过一次回调，结果写入同一个复用缓冲区
+
+        zoom 为 False 时只做淡入淡出；淡入淡出时长不超过片段时长的1/3。
+        bake 为 True 时在一个循环里把整段帧一次算进预分配的 (N, 高, 宽, 3) 数组，返回 ImageSequenceClip，
+        编码时不再逐帧经过 MoviePy 的回调；片段只有不到一秒，内存占用有限。
+        没有 cv2 也没有 numba 时退回分别添加缩放和淡入淡出
+        """
+        duration = clip.duration
+        fps = clip.fps
+        if (zoom and cv2 is None and _zoom_fade is None) or not fps or not duration:
+            clip = self._add_simple_zoom_effect(clip) if zoom else clip
+            return self._add_fade_effects(clip, fade_duration)
+
+        actual_fade = min(fade_duration, duration / 3)
+        scales, matrices = _zoom_schedule(duration, fps, *clip.size) if zoom else (None, None)
+        buffers = {}
+
+        def render(frame, t, dst):
+            alpha = 1.0
+            if actual_fade > 0:
+                if t < actual_fade:
+                    alpha = t / actual_fade
+                elif t > duration - actual_fade:
+                    alpha = (duration - t) / actual_fade
+                alpha = max(0.0, min(1.0, alpha))
+            if scales is None and alpha >= 1.0:
+                return frame
+            if scales is not None:
+                index = min(max(int(t * fps + 1e-6), 0), len(scales) - 1)
+                if cv2 is None:
+                    # Numba 内核一次遍历完成缩放和亮度缩放
+                    return _zoom_fade(frame, float(scales[index]), int(alpha * 256), dst)
+                frame = _warp_frame(frame, matrices[index], dst)
+            # cv2 路径在缩放结果上原地缩放亮度，数据仍在缓存中
+            return _scale_frame(frame, alpha, dst) if alpha < 1.0 else frame
+
+        if bake:
+            # 每帧直接写入帧栈中对应的位置；单帧字节数是 32 的倍数时各帧仍按 32 字节对齐
+            w, h = clip.size
+            frame_count = max(1, int(round(duration * fps)))
+            frames = _aligned_empty((frame_count, h, w, 3))
+            for k in range(frame_count):
+                t = k / fps
+                dst = frames[k]
+                result = render(clip.get_frame(t), t, dst)
+                if not np.may_share_memory(result, dst):
+                    dst[...] = result
+            return ImageSequenceClip(list(frames), fps=fps)
+
+        def zoom_fade(get_frame, t):
+            frame = get_frame(t)
+            dst = buffers.get(frame.shape)
+            if dst is None:
+                dst = buffers[frame.shape] = _aligned_empty(frame.shape)
+            return render(frame, t, dst)
+
+        return clip.transform(zoom_fade)
+
     def _add_simple_zoom_effect(self, clip):
         """使用 MoviePy 2.x 的 transform 方法添加安全的动态缩放效果"""
         try:
             # 使用 transform 方法来实现基于时间的动态缩放 (MoviePy 2.x 正确 API)
-            if hasattr(clip, 'transform') and cv2 is not None:
+            if cv2 is not None or _zoom_center_crop is not None:
+                # 片段时长在闭包外计算一次
+                duration = clip.duration or self.beat_frame_duration
+                # 每个片段一个 32 字节对齐的输出缓冲区，逐帧复用；帧在下一次取帧前已被合成或编码消费
+                zoom_buffers = {}
+
+                # 逐帧只需按帧号查表，表在相同时长/帧率/尺寸的片段间共用
+                fps = getattr(clip, 'fps', None)
+                zoom_table = None
+                if fps and duration > 0:
+                    _, zoom_table = _zoom_schedule(duration, fps, *clip.size)
+
                 def safe_dynamic_zoom(get_frame, t):
                     """安全的基于时间的动态缩放函数"""
                     try:
@@ -327,13 +864,18 @@ class VideoProcessor:
                         if frame is None:
                             return frame
 
-                        h, w = frame.shape[:2]
-
                         # 确保时间在有效范围内
-                        duration = clip.duration if hasattr(clip, 'duration') and clip.duration else self.beat_frame_duration
                         if duration <= 0:
                             return frame
 
+                        dst = zoom_buffers.get(frame.shape)
+                        if dst is None:
+                            dst = zoom_buffers[frame.shape] = _aligned_empty(frame.shape)
+
+                        if zoom_table is not None and tuple(frame.shape[1::-1]) == tuple(clip.size):
+                            index = min(max(int(t * fps + 1e-6), 0), len(zoom_table) - 1)
+                            return _warp_frame(frame, zoom_table[index], dst)
+
                         # 安全的时间进度计算，避免边界问题
                         safe_t = max(0, min(t, duration - 0.001))  # 确保在有效范围内
                         progress = safe_t / duration  # 获取当前时间在片段中的进度 (0-1)
@@ -344,32 +886,7 @@ class VideoProcessor:
                         # 确保缩放比例在安全范围内
                         scale = max(1.0, min(scale, 1.05))
 
-                        new_h, new_w = int(h * scale), int(w * scale)
-
-                        # 确保新尺寸有效
-                        if new_h <= 0 or new_w <= 0:
-                            return frame
-
-                        # 放大图像
-                        resized_frame = cv2.resize(frame, (new_w, new_h))
-
-                        # 安全的中心裁剪，添加边界检查
-                        start_x = max(0, (new_w - w) // 2)
-                        start_y = max(0, (new_h - h) // 2)
-                        end_x = min(new_w, start_x + w)
-                        end_y = min(new_h, start_y + h)
-
-                        # 确保裁剪区域有效
-                        if end_x <= start_x or end_y <= start_y:
-                            return frame
-
-                        cropped_frame = resized_frame[start_y:end_y, start_x:end_x]
-
-                        # 如果裁剪后尺寸不匹配，进行最终调整
-                        if cropped_frame.shape[:2] != (h, w):
-                            cropped_frame = cv2.resize(cropped_frame, (w, h))
-
-                        return cropped_frame
+                        return _center_zoom(frame, scale, dst)
 
                     except Exception as e:
                         print(f"缩放效果处理出错: {e}, 返回原始帧")
@@ -379,12 +896,17 @@ class VideoProcessor:
                 zoom_clip = clip.transform(safe_dynamic_zoom)
                 return zoom_clip
 
-            # 回退：尝试使用基于PIL的动态缩放 (如果cv2不可用但有PIL)
-            elif hasattr(clip, 'transform') and cv2 is None:
+            # 回退：尝试使用基于PIL的动态缩放 (cv2 和 numba 都不可用但有PIL)
+            else:
                 try:
                     from PIL import Image
                     import numpy as np
 
+                    # 缩放比例同样按帧号查表，闭包外取一次
+                    duration = clip.duration or self.beat_frame_duration
+                    fps = getattr(clip, 'fps', None)
+                    scale_table = _zoom_schedule(duration, fps, *clip.size)[0] if fps and duration > 0 else None
+
                     def safe_pil_dynamic_zoom(get_frame, t):
                         """使用PIL的安全动态缩放函数"""
                         try:
@@ -396,55 +918,31 @@ class VideoProcessor:
                             base_size = img.size
 
                             # 确保时间在有效范围内
-                            duration = clip.duration if hasattr(clip, 'duration') and clip.duration else self.beat_frame_duration
                             if duration <= 0:
                                 img.close()
                                 return frame
 
-                            # 安全的时间进度计算
-                            safe_t = max(0, min(t, duration - 0.001))
-                            progress = safe_t / duration
-
-                            # 使用更小的缩放比例避免黑屏：从1.0到1.03再回到1.0
-                            zoom_ratio = 0.03 * math.sin(progress * 2 * math.pi)
-                            scale = 1.0 + zoom_ratio
-
-                            # 确保缩放比例在安全范围内
-                            scale = max(1.0, min(scale, 1.05))
-
-                            new_size = [
-                                max(1, math.ceil(img.size[0] * scale)),
-                                max(1, math.ceil(img.size[1] * scale))
-                            ]
-
-                            # 确保新尺寸是偶数且有效
-                            new_size[0] = new_size[0] + (new_size[0] % 2)
-                            new_size[1] = new_size[1] + (new_size[1] % 2)
-
-                            # 调整图像大小
-                            img = img.resize(new_size, Image.LANCZOS)
-
-                            # 安全的裁剪到原始大小
-                            x = max(0, (new_size[0] - base_size[0]) // 2)
-                            y = max(0, (new_size[1] - base_size[1]) // 2)
-
-                            # 确保裁剪坐标有效
-                            x2 = min(new_size[0], x + base_size[0])
-                            y2 = min(new_size[1], y + base_size[1])
-
-                            if x2 <= x or y2 <= y:
-                                img.close()
-                                return frame
-
-                            cropped = img.crop([x, y, x2, y2])
-
-                            # 确保最终尺寸正确
-                            if cropped.size != base_size:
-                                cropped = cropped.resize(base_size, Image.LANCZOS)
-
-                            result = np.array(cropped)
+                            if scale_table is not None:
+                                scale = float(scale_table[min(max(int(t * fps + 1e-6), 0), len(scale_table) - 1)])
+                            else:
+                                # 安全的时间进度计算
+                                safe_t = max(0, min(t, duration - 0.001))
+                                progress = safe_t / duration
+
+                                # 使用更小的缩放比例避免黑屏：从1.0到1.03再回到1.0，限制在安全范围内
+                                scale = max(1.0, min(1.0 + 0.03 * math.sin(progress * 2 * math.pi), 1.05))
+
+                            # 缩放和中心裁剪合并为一次仿射变换（输出坐标到输入坐标的逆映射）
+                            w, h = base_size
+                            inv = 1.0 / scale
+                            zoomed = img.transform(base_size, Image.AFFINE,
+                                                   (inv, 0, w / 2 * (1 - inv), 0, inv, h / 2 * (1 - inv)),
+                                                   resample=Image.BILINEAR)
+
+                            # asarray 只从 PIL 缓冲区拷贝一次，np.array 还会再复制一份
+                            result = np.asarray(zoomed)
                             img.close()
-                            cropped.close()
+                            zoomed.close()
                             return result
 
                         except Exception as e:
@@ -459,107 +957,8 @@ class VideoProcessor:
                     print("PIL不可用，跳过PIL动态缩放方案")
                     pass
 
-            # 回退：使用 image_transform 方法 (MoviePy 2.x 的正确 API) - 静态缩放
-            if hasattr(clip, 'image_transform') and cv2 is not None:
-                def safe_zoom_function(frame):
-                    """对每一帧应用安全的缩放效果"""
-                    try:
-                        if frame is None:
-                            return frame
-
-                        h, w = frame.shape[:2]
-                        scale = 1.03  # 轻微放大3%
-                        new_h, new_w = max(1, int(h * scale)), max(1, int(w * scale))
-
-                        # 确保新尺寸有效
-                        if new_h <= 0 or new_w <= 0:
-                            return frame
-
-                        # 放大图像
-                        resized_frame = cv2.resize(frame, (new_w, new_h))
-
-                        # 安全的中心裁剪
-                        start_x = max(0, (new_w - w) // 2)
-                        start_y = max(0, (new_h - h) // 2)
-                        end_x = min(new_w, start_x + w)
-                        end_y = min(new_h, start_y + h)
-
-                        if end_x <= start_x or end_y <= start_y:
-                            return frame
-
-                        cropped_frame = resized_frame[start_y:end_y, start_x:end_x]
-
-                        # 确保最终尺寸正确
-                        if cropped_frame.shape[:2] != (h, w):
-                            cropped_frame = cv2.resize(cropped_frame, (w, h))
-
-                        return cropped_frame
-
-                    except Exception as e:
-                        print(f"静态缩放处理出错: {e}, 返回原始帧")
-                        return frame
-
-                print("使用优化的 image_transform 方法添加安全静态缩放效果")
-                zoom_clip = clip.image_transform(safe_zoom_function)
-                return zoom_clip
-
-            # 回退到 fl_image 方法（如果存在）
-            elif hasattr(clip, 'fl_image') and cv2 is not None:
-                def safe_static_zoom_function(frame):
-                    """安全的静态缩放函数"""
-                    try:
-                        if frame is None:
-                            return frame
-
-                        h, w = frame.shape[:2]
-                        scale = 1.03  # 轻微放大3%
-                        new_h, new_w = max(1, int(h * scale)), max(1, int(w * scale))
-
-                        if new_h <= 0 or new_w <= 0:
-                            return frame
-
-                        resized_frame = cv2.resize(frame, (new_w, new_h))
-                        start_x = max(0, (new_w - w) // 2)
-                        start_y = max(0, (new_h - h) // 2)
-                        end_x = min(new_w, start_x + w)
-                        end_y = min(new_h, start_y + h)
-
-                        if end_x <= start_x or end_y <= start_y:
-                            return frame
-
-                        cropped_frame = resized_frame[start_y:end_y, start_x:end_x]
-
-                        if cropped_frame.shape[:2] != (h, w):
-                            cropped_frame = cv2.resize(cropped_frame, (w, h))
-
-                        return cropped_frame
-
-                    except Exception as e:
-                        print(f"fl_image缩放处理出错: {e}, 返回原始帧")
-                        return frame
-
-                print("使用优化的 fl_image 方法添加安全缩放效果")
-                zoom_clip = clip.fl_image(safe_static_zoom_function)
-                return zoom_clip
-
-            # 最终回退到基本 resize 方法
-            elif hasattr(clip, 'resized') or hasattr(clip, 'resize'):
-                print("使用基础 resize 方法添加缩放效果")
-                scale = 1.03
-                enlarged_size = (int(self.output_size[0] * scale), int(self.output_size[1] * scale))
-
-                if hasattr(clip, 'resized'):
-                    enlarged_clip = clip.resized(enlarged_size)
-                    zoom_clip = enlarged_clip.resized(self.output_size)
-                else:
-                    enlarged_clip = clip.resize(enlarged_size)
-                    zoom_clip = enlarged_clip.resize(self.output_size)
-
-                return zoom_clip
-
-            else:
-                print("无法应用任何缩放效果，返回原始片段")
-                return clip
+            print("无法应用任何缩放效果，返回原始片段")
+            return clip
 
         except Exception as e:
             print(f"缩放效果失败: {e}")
@@ -585,37 +984,11 @@ class VideoProcessor:
                 print(f"警告: 片段时长太短，无法添加淡入淡出效果")
                 return clip
 
-            # 添加淡入淡出效果
-            if hasattr(clip, 'with_effects'):
-                # MoviePy 2.x 新API
-                try:
-                    from moviepy.video.fx import FadeIn, FadeOut
-                    clip_with_fade = clip.with_effects([FadeIn(actual_fade), FadeOut(actual_fade)])
-                    print(f"使用 with_effects 添加淡入淡出效果: {actual_fade:.2f}s")
-                    return clip_with_fade
-                except ImportError:
-                    print("MoviePy FadeIn/FadeOut 效果不可用，尝试其他方法")
-
-            # 尝试使用 fadein/fadeout 方法
-            if hasattr(clip, 'fadein') and hasattr(clip, 'fadeout'):
-                try:
-                    clip_with_fade = clip.fadein(actual_fade).fadeout(actual_fade)
-                    print(f"使用 fadein/fadeout 方法添加淡入淡出效果: {actual_fade:.2f}s")
-                    return clip_with_fade
-                except Exception as fade_error:
-                    print(f"fadein/fadeout 方法失败: {fade_error}")
-
-            # 尝试使用 crossfadein/crossfadeout
-            if hasattr(clip, 'crossfadein') and hasattr(clip, 'crossfadeout'):
-                try:
-                    clip_with_fade = clip.crossfadein(actual_fade).crossfadeout(actual_fade)
-                    print(f"使用 crossfadein/crossfadeout 方法添加淡入淡出效果: {actual_fade:.2f}s")
-                    return clip_with_fade
-                except Exception as crossfade_error:
-                    print(f"crossfadein/crossfadeout 方法失败: {crossfade_error}")
-
-            # 手动实现淡入淡出效果（使用透明度）
+            # 逐帧按 alpha 缩放亮度实现淡入淡出，全程 uint8，比 FadeIn/FadeOut 的浮点运算更快；
+            # 输出写入每个片段一个的复用缓冲区，不再逐帧分配
             try:
+                fade_buffers = {}
+
                 def fade_function(get_frame, t):
                     frame = get_frame(t)
                     if frame is None:
@@ -636,17 +1009,16 @@ class VideoProcessor:
 
                     # 应用透明度
                     if alpha < 1.0:
-                        frame = (frame * alpha).astype(np.uint8)
+                        dst = fade_buffers.get(frame.shape)
+                        if dst is None:
+                            dst = fade_buffers[frame.shape] = _aligned_empty(frame.shape)
+                        frame = _scale_frame(frame, alpha, dst)
 
                     return frame
 
-                if hasattr(clip, 'transform'):
-                    clip_with_fade = clip.transform(fade_function)
-                    print(f"使用手动transform实现淡入淡出效果: {actual_fade:.2f}s")
-                    return clip_with_fade
-                else:
-                    print("无法实现淡入淡出效果，返回原始片段")
-                    return clip
+                clip_with_fade = clip.transform(fade_function)
+                print(f"使用transform实现淡入淡出效果: {actual_fade:.2f}s")
+                return clip_with_fade
 
             except Exception as manual_error:
                 print(f"手动淡入淡出效果失败: {manual_error}")
@@ -676,37 +1048,10 @@ class VideoProcessor:
                 print(f"警告: 片段时长太短，无法添加淡入效果")
                 return clip
 
-            # 添加淡入效果
-            if hasattr(clip, 'with_effects'):
-                # MoviePy 2.x 新API
-                try:
-                    from moviepy.video.fx import FadeIn
-                    clip_with_fade = clip.with_effects([FadeIn(actual_fade)])
-                    print(f"使用 with_effects 添加淡入效果: {actual_fade:.2f}s")
-                    return clip_with_fade
-                except ImportError:
-                    print("MoviePy FadeIn 效果不可用，尝试其他方法")
-
-            # 尝试使用 fadein 方法
-            if hasattr(clip, 'fadein'):
-                try:
-                    clip_with_fade = clip.fadein(actual_fade)
-                    print(f"使用 fadein 方法添加淡入效果: {actual_fade:.2f}s")
-                    return clip_with_fade
-                except Exception as fade_error:
-                    print(f"fadein 方法失败: {fade_error}")
-
-            # 尝试使用 crossfadein
-            if hasattr(clip, 'crossfadein'):
-                try:
-                    clip_with_fade = clip.crossfadein(actual_fade)
-                    print(f"使用 crossfadein 方法添加淡入效果: {actual_fade:.2f}s")
-                    return clip_with_fade
-                except Exception as crossfade_error:
-                    print(f"crossfadein 方法失败: {crossfade_error}")
-
-            # 手动实现淡入效果
+            # 逐帧按 alpha 缩放亮度实现淡入，全程 uint8，输出写入复用的缓冲区
             try:
+                fade_buffers = {}
+
                 def fade_in_function(get_frame, t):
                     frame = get_frame(t)
                     if frame is None:
@@ -716,17 +1061,16 @@ class VideoProcessor:
                     if t < actual_fade:
                         alpha = t / actual_fade
                         alpha = max(0.0, min(1.0, alpha))
-                        frame = (frame * alpha).astype(np.uint8)
+                        dst = fade_buffers.get(frame.shape)
+                        if dst is None:
+                            dst = fade_buffers[frame.shape] = _aligned_empty(frame.shape)
+                        frame = _scale_frame(frame, alpha, dst)
 
                     return frame
 
-                if hasattr(clip, 'transform'):
-                    clip_with_fade = clip.transform(fade_in_function)
-                    print(f"使用手动transform实现淡入效果: {actual_fade:.2f}s")
-                    return clip_with_fade
-                else:
-                    print("无法实现淡入效果，返回原始片段")
-                    return clip
+                clip_with_fade = clip.transform(fade_in_function)
+                print(f"使用transform实现淡入效果: {actual_fade:.2f}s")
+                return clip_with_fade
 
             except Exception as manual_error:
                 print(f"手动淡入效果失败: {manual_error}")
@@ -856,6 +1200,176 @@ class VideoProcessor:
                 print("返回原始视频（不含时间显示）")
                 return video
 
+    def _prepare_beat_clip(self, i, clip):
+        """
+        统一卡点片段尺寸并验证时长，片段无效时返回 None
+
+        黑帧检查和淡入淡出已在 _create_beat_clips 中与缩放一起完成
+        """
+        try:
+            # 验证片段是否有效
+            if clip.duration <= 0:
+                print(f"警告: 卡点片段 {i + 1} 持续时间无效: {clip.duration}")
+                return None
+
+            # 尺寸不一致时才统一尺寸
+            clip = self._fit(clip)
+            print(f"卡点片段 {i + 1}: 尺寸 {clip.size}, 持续时间 {clip.duration:.2f}s ✓")
+            return clip
+
+        except Exception as e:
+            print(f"处理卡点片段 {i + 1} 时出错: {e}")
+            print(f"跳过卡点片段 {i + 1}")
+            return None
+
+    @staticmethod
+    def _process_budget(task_count):
+        """
+        一个后台任务可用的子进程数和每个子进程的编码线程数
+
+        后台任务本身已在 app 的进程池中运行，全机最多 MAX_CONCURRENT_ENCODES 个；
+        每个任务只使用其中一份 CPU 核心，子进程数不超过 task_count
+        """
+        cores = max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_ENCODES)
+        workers = max(1, min(task_count, cores))
+        return workers, max(1, cores // workers)
+
+    @staticmethod
+    def _map_in_processes(fn, *iterables, workers, threads):
+        """在 workers 个 spawn 子进程中执行 fn，每次调用末尾追加编码线程数 threads，按顺序返回结果列表"""
+        count = len(iterables[0])
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(VideoProcessor._ffmpeg_ok, VideoProcessor._hw_write_opts)) as pool:
+            return list(pool.map(fn, *iterables, [threads] * count))
+
+    def _render_beat_clips_parallel(self, video_path, beat_times, work_dir):
+        """把卡点分组后在多个进程中并行渲染，每个进程独立打开视频，返回按顺序排列的片段文件"""
+        workers, threads = self._process_budget(len(beat_times))
+        chunk_size = math.ceil(len(beat_times) / workers)
+        starts = list(range(0, len(beat_times), chunk_size))
+        chunks = [beat_times[k:k + chunk_size] for k in starts]
+        results = self._map_in_processes(_render_beat_chunk, [video_path] * len(chunks), chunks,
+                                         starts, [work_dir] * len(chunks),
+                                         workers=len(chunks), threads=threads)
+        return [path for paths in results for path in paths]
+
+    def _render_combined_parallel(self, video_path, beat_times, main_video, output_path, work_dir,
+                                  music_path=None):
+        """并行渲染卡点片段，再由 FFmpeg 把片段与管道送入的主体拼接并混入背景音乐，只编码一次"""
+        beat_paths = self._render_beat_clips_parallel(video_path, beat_times, work_dir)
+
+        # 主体不再先写成中间文件：原始帧经管道作为第 0 路输入，与卡点片段在同一次编码中拼接并混音
+        # 卡点片段参数一致，用 concat demuxer 直接读取；与主体拼接时统一尺寸
+        width, height = self.output_size
+        normalize = f"scale={width}:{height},setsar=1"
+        if beat_paths:
+            list_path = os.path.join(work_dir, 'beats.txt')
+            with open(list_path, 'w', encoding='utf-8') as f:
+                f.writelines(f"file '{path}'\n" for path in beat_paths)
+            extra_inputs = [['-f', 'concat', '-safe', '0', '-i', list_path]]
+            graph = f"[1:v]{normalize}[b];[0:v]{normalize}[m];[b][m]concat=n=2:v=1:a=0[outv]"
+        else:
+            extra_inputs = []
+            graph = f"[0:v]{normalize}[outv]"
+        # 只给主视频添加淡入效果（开始时）
+        self._pipe_to_ffmpeg(self._add_fade_in(main_video, self.fade_duration), output_path, music_path,
+                             extra_inputs, graph)
+
+    def _resolve_music_path(self, music_path=None):
+        """确定背景音乐文件（默认使用jiggy boogy.mp3），传 False 或文件不存在时返回 None"""
+        if music_path is False:
+            return None
+        if music_path is None:
+            music_path = str(Path(__file__).parent / "jiggy boogy.mp3")
+        if not os.path.exists(music_path):
+            print(f"警告: 背景音乐文件不存在: {music_path}")
+            return None
+        return music_path
+
+    def _encoder_attempts(self):
+        """成片编码的尝试顺序：有硬件编码器时先用硬件编码，失败后用 libx264 重试"""
+        return (True, False) if self._hw_encoder else (False,)
+
+    def _hw_upload_filter(self, hw):
+        """硬件编码需要把帧上传到显存时（VAAPI），返回追加在 filter_complex 输出前的上传滤镜"""
+        params = self._hw_encoder['ffmpeg_params'] if hw else []
+        return f",{params[params.index('-vf') + 1]}" if '-vf' in params else ''
+
+    def _output_args(self, music_input=None, hw=False, filtered=False):
+        """
+        成片的视频编码与混音参数，music_input 为音乐的输入序号，None 表示不混入音乐
+
+        filtered 为 True 表示输出来自 filter_complex，-vf 不能同时使用，上传滤镜由 _hw_upload_filter 并入滤镜图
+        """
+        opts = self._hw_encoder if hw else self.TEMP_WRITE_OPTS
+        args = ['-c:v', opts['codec']]
+        if opts.get('preset'):
+            args += ['-preset', opts['preset']]
+        params = list(opts['ffmpeg_params'])
+        if filtered and '-vf' in params:
+            del params[params.index('-vf'):params.index('-vf') + 2]
+        args += params
+        if music_input is not None:
+            args += ['-map', f'{music_input}:a:0', '-c:a', 'aac', '-shortest']
+        if '-movflags' not in args:
+            args += MP4_OUTPUT_ARGS
+        return args
+
+    def _pipe_to_ffmpeg(self, clip, output_path, music_path=None, extra_inputs=(), graph=None):
+        """
+        把 MoviePy 合成的原始帧通过管道直接交给 FFmpeg 编码，同时混入背景音乐，不再写临时视频再混音
+
+        管道固定为第 0 路输入；extra_inputs 为追加的输入参数列表（每项一路输入），
+        此时由 graph 给出 filter_complex，输出标签为 [outv]
+        """
+        width, height = clip.size
+        fps = clip.fps or self.output_fps
+        music_input = 1 + len(extra_inputs) if music_path else None
+        with atomic_output(output_path) as temp_path:
+            for hw in self._encoder_attempts():
+                cmd = [self._ffmpeg, '-y', '-v', 'error',
+                       '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(fps),
+                       '-i', 'pipe:0']
+                for input_args in extra_inputs:
+                    cmd += input_args
+                if music_path:
+                    cmd += ['-stream_loop', '-1', '-i', music_path]
+                if graph:
+                    upload = self._hw_upload_filter(hw)
+                    hw_graph = graph[:-len('[outv]')] + upload + '[outv]' if upload else graph
+                    cmd += ['-filter_complex', hw_graph, '-map', '[outv]']
+                else:
+                    cmd += ['-map', '0:v']
+                cmd += [*self._output_args(music_input, hw, filtered=bool(graph)), temp_path]
+
+                # stderr 写入临时文件，避免管道写满后与 stdin 互相阻塞
+                with tempfile.TemporaryFile() as stderr:
+                    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=stderr, bufsize=1 << 20)
+                    try:
+                        for frame in clip.iter_frames(fps=fps, dtype='uint8'):
+                            # 连续的 uint8 帧直接以 memoryview 写入，省去 tobytes() 的整帧拷贝
+                            proc.stdin.write(memoryview(np.ascontiguousarray(frame, dtype=np.uint8)))
+                    except BrokenPipeError:
+                        # -shortest 在音乐结束时提前退出，或 FFmpeg 出错，以返回码为准
+                        pass
+                    except Exception:
+                        proc.kill()
+                        proc.wait()
+                        raise
+                    finally:
+                        try:
+                            proc.stdin.close()
+                        except BrokenPipeError:
+                            pass
+                    if proc.wait() == 0:
+                        return
+                    stderr.seek(0)
+                    error = stderr.read().decode(errors='replace')[-2000:]
+                logger.warn(f"FFmpeg 管道编码失败: {error}")
+            raise Exception(f"FFmpeg 管道编码失败: {error}")
+
     def _combine_clips(self, beat_clips, main_video):
         """组合所有视频片段 - 带淡入淡出效果"""
         all_clips = []
@@ -863,59 +1377,21 @@ class VideoProcessor:
 
         print(f"准备组合 {len(beat_clips)} 个卡点片段和1个主视频，添加淡入淡出效果")
 
-        # 确保所有卡点片段都有相同的尺寸并验证内容，添加淡入淡出效果
+        # 确保所有卡点片段都有相同的尺寸（淡入淡出已在创建卡点片段时添加）
         for i, clip in enumerate(beat_clips):
-            try:
-                # 验证片段是否有效
-                if clip.duration <= 0:
-                    print(f"警告: 卡点片段 {i + 1} 持续时间无效: {clip.duration}")
-                    continue
-
-                # 强制统一尺寸
-                clip = clip.resized(self.output_size)
-
-                # 验证片段内容（检查是否为纯黑帧）
-                try:
-                    # 获取第一帧进行验证
-                    first_frame = clip.get_frame(0)
-                    if first_frame is not None and first_frame.mean() > 5:  # 避免纯黑帧
-                        # 添加淡入淡出效果
-                        clip_with_fade = self._add_fade_effects(clip, fade_duration)
-                        all_clips.append(clip_with_fade)
-                        print(f"卡点片段 {i + 1}: 尺寸 {clip.size}, 持续时间 {clip.duration:.2f}s, 已添加淡入淡出 ✓")
-                    else:
-                        print(f"警告: 卡点片段 {i + 1} 可能是黑帧，跳过")
-                except Exception as frame_e:
-                    print(f"无法验证卡点片段 {i + 1} 的帧内容: {frame_e}")
-                    # 仍然添加，但标记警告
-                    clip_with_fade = self._add_fade_effects(clip, fade_duration)
-                    all_clips.append(clip_with_fade)
-                    print(f"卡点片段 {i + 1}: 尺寸 {clip.size}, 持续时间 {clip.duration:.2f}s, 已添加淡入淡出 (未验证)")
-
-            except Exception as e:
-                print(f"处理卡点片段 {i + 1} 时出错: {e}")
-                try:
-                    clip = clip.resize(self.output_size)
-                    clip_with_fade = self._add_fade_effects(clip, fade_duration)
-                    all_clips.append(clip_with_fade)
-                except:
-                    print(f"跳过卡点片段 {i + 1}")
-                    continue
+            clip_with_fade = self._prepare_beat_clip(i, clip)
+            if clip_with_fade is not None:
+                all_clips.append(clip_with_fade)
 
         # 确保主视频也有正确的尺寸，并添加淡入效果
         try:
-            main_video = main_video.resized(self.output_size)
+            main_video = self._fit(main_video)
             # 只给主视频添加淡入效果（开始时）
             main_video_with_fade = self._add_fade_in(main_video, fade_duration)
             print(f"主视频: 尺寸 {main_video.size}, 持续时间 {main_video.duration:.2f}s, 已添加淡入效果")
         except Exception as e:
             print(f"调整主视频尺寸时出错: {e}")
-            try:
-                main_video = main_video.resize(self.output_size)
-                main_video_with_fade = self._add_fade_in(main_video, fade_duration)
-            except:
-                print("警告: 无法调整主视频尺寸")
-                main_video_with_fade = main_video
+            main_video_with_fade = main_video
 
         # 添加主视频到片段列表
         all_clips.append(main_video_with_fade)
@@ -924,39 +1400,35 @@ class VideoProcessor:
 
         # 连接所有片段，使用安全的参数避免黑帧
         try:
-            # 使用method='compose'确保更好的兼容性，避免黑屏
-            final_video = concatenate_videoclips(all_clips, method='compose')
+            final_video = self._sequence_clips(all_clips)
             print(f"成功连接所有片段，最终视频长度: {final_video.duration:.2f}s")
             return final_video
         except Exception as e:
             print(f"连接视频时出错: {e}")
 
-            # 尝试逐个检查和修复
+            # 尝试逐个检查和修复，只缩放尺寸不一致的片段
             fixed_clips = []
             for i, clip in enumerate(all_clips):
                 try:
-                    # 再次强制统一尺寸和属性
-                    if hasattr(clip, 'resized'):
-                        fixed_clip = clip.resized(self.output_size)
-                    else:
-                        fixed_clip = clip.resize(self.output_size)
-
-                    # 确保有音频轨道（如果原始视频有的话）
-                    if hasattr(clip, 'audio') and clip.audio is not None:
-                        fixed_clip = fixed_clip.set_audio(clip.audio)
-
-                    fixed_clips.append(fixed_clip)
-                    print(f"修复片段 {i + 1} 成功")
+                    clip = self._fit(clip)
                 except Exception as fix_e:
                     print(f"修复片段 {i + 1} 失败: {fix_e}")
-                    # 如果修复失败，尝试使用原始片段
-                    fixed_clips.append(clip)
+                fixed_clips.append(clip)
 
             # 再次尝试连接，使用安全参数
-            final_video = concatenate_videoclips(fixed_clips, method='compose')
+            final_video = self._sequence_clips(fixed_clips)
             print(f"修复后成功连接，最终视频长度: {final_video.duration:.2f}s")
             return final_video
 
+    def _sequence_clips(self, clips):
+        """按累计时长给各片段设置起始时间，用一个 CompositeVideoClip 顺序排列，统一为最高的帧率输出"""
+        offsets = np.cumsum([0] + [c.duration for c in clips[:-1]])
+        fps = max((c.fps for c in clips if c.fps), default=self.output_fps)
+        return CompositeVideoClip(
+            [c.with_start(float(offset)) for c, offset in zip(clips, offsets)],
+            size=self.output_size, bg_color=(0, 0, 0)
+        ).with_duration(sum(c.duration for c in clips)).with_fps(fps)
+
     def _add_background_music(self, video_clip, music_path=None):
         """
         为视频添加背景音乐
@@ -982,34 +1454,11 @@ class VideoProcessor:
             # 加载背景音乐
             audio_clip = AudioFileClip(music_path)
 
-            # 如果音频比视频短，循环播放音频
+            # 如果音频比视频短，循环播放音频（AudioLoop 只做时间映射，不复制音频数据；
+            # 主流程的循环已交给 FFmpeg 的 -stream_loop）
             if audio_clip.duration < video_clip.duration:
                 print(f"音频时长 {audio_clip.duration:.2f}s 短于视频时长 {video_clip.duration:.2f}s，需要循环播放")
-                # 计算需要循环的次数
-                loops = int(video_clip.duration / audio_clip.duration) + 1
-                # 创建循环音频片段
-                looped_clips = []
-                for i in range(loops):
-                    # 创建音频的独立副本
-                    clip_copy = audio_clip.subclipped(0, audio_clip.duration)
-                    looped_clips.append(clip_copy)
-
-                try:
-                    audio_clip = concatenate_audioclips(looped_clips)
-                except Exception as concat_error:
-                    print(f"音频拼接失败，使用备用方法: {concat_error}")
-                    # 使用音频自身的loop功能
-                    audio_clip = audio_clip.loop(duration=video_clip.duration)
-
-                # 截取到确切的视频长度
-                audio_clip = audio_clip.subclipped(0, video_clip.duration)
-
-                # 清理临时片段
-                for clip in looped_clips:
-                    try:
-                        clip.close()
-                    except:
-                        pass
+                audio_clip = audio_clip.with_effects([afx.AudioLoop(duration=video_clip.duration)])
             else:
                 # 如果音频比视频长，截取音频
                 print(f"音频时长 {audio_clip.duration:.2f}s 长于视频时长 {video_clip.duration:.2f}s，截取音频")
@@ -1100,40 +1549,39 @@ class VideoProcessor:
         """
         try:
             # 确定音乐文件路径
+            music_path = self._resolve_music_path(music_path)
             if music_path is None:
-                music_path = str(Path(__file__).parent / "jiggy boogy.mp3")
-
-            if not os.path.exists(music_path):
-                print(f"警告: 背景音乐文件不存在: {music_path}")
                 return False
 
             print(f"使用 FFmpeg 添加背景音乐: {music_path}")
 
-            # 构建 FFmpeg 命令
-            cmd = [
-                'ffmpeg',
-                '-i', video_path,  # 输入视频
-                '-i', music_path,  # 输入音频
-                '-c:v', 'copy',  # 复制视频流（不重新编码）
-                '-c:a', 'aac',  # 音频编码为 AAC
-                '-map', '0:v:0',  # 使用第一个文件的视频流
-                '-map', '1:a:0',  # 使用第二个文件的音频流
-                '-shortest',  # 使用最短的流长度
-                '-y',  # 覆盖输出文件
-                output_path
-            ]
-
-            print(f"FFmpeg 命令: {' '.join(cmd)}")
-
-            # 执行 FFmpeg 命令
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-
-            if result.returncode == 0:
-                print("FFmpeg 添加音频成功!")
-                return True
-            else:
-                print(f"FFmpeg 错误: {result.stderr}")
-                return False
+            # 先写到输出目录中的临时文件，成功后再替换，失败时不会覆盖或留下残缺的输出
+            with atomic_output(output_path) as temp_path:
+                # 构建 FFmpeg 命令
+                cmd = [
+                    self._ffmpeg,
+                    '-i', video_path,  # 输入视频
+                    '-stream_loop', '-1',  # 音频较短时循环播放
+                    '-i', music_path,  # 输入音频
+                    '-c:v', 'copy',  # 复制视频流（不重新编码）
+                    '-c:a', 'aac',  # 音频编码为 AAC
+                    '-map', '0:v:0',  # 使用第一个文件的视频流
+                    '-map', '1:a:0',  # 使用第二个文件的音频流
+                    '-shortest',  # 使用最短的流长度
+                    '-y',  # 覆盖输出文件
+                    temp_path
+                ]
+
+                print(f"FFmpeg 命令: {' '.join(cmd)}")
+
+                # 执行 FFmpeg 命令
+                returncode, stderr = _run_ffmpeg(cmd, timeout=300)
+
+                if returncode != 0:
+                    raise Exception(f"FFmpeg 错误: {stderr}")
+
+            print("FFmpeg 添加音频成功!")
+            return True
 
         except subprocess.TimeoutExpired:
             print("FFmpeg 超时")
@@ -1180,10 +1628,7 @@ class VideoProcessor:
 
             # 调整画中画尺寸
             try:
-                if hasattr(pip_clip, 'resized'):
-                    resized_pip = pip_clip.resized((pip_width, pip_height))
-                else:
-                    resized_pip = pip_clip.resize((pip_width, pip_height))
+                resized_pip = pip_clip.resized((pip_width, pip_height))
                 print(f"画中画调整到尺寸: {pip_width}x{pip_height}")
             except Exception as resize_error:
                 print(f"调整画中画尺寸失败: {resize_error}")
@@ -1192,10 +1637,7 @@ class VideoProcessor:
             # 设置画中画透明度
             if pip_opacity < 1.0:
                 try:
-                    if hasattr(resized_pip, 'with_opacity'):
-                        resized_pip = resized_pip.with_opacity(pip_opacity)
-                    else:
-                        resized_pip = resized_pip.set_opacity(pip_opacity)
+                    resized_pip = resized_pip.with_opacity(pip_opacity)
                     print(f"设置画中画透明度: {pip_opacity}")
                 except Exception as opacity_error:
                     print(f"设置透明度失败: {opacity_error}")
@@ -1223,10 +1665,7 @@ class VideoProcessor:
 
             # 设置画中画位置
             try:
-                if hasattr(resized_pip, 'with_position'):
-                    positioned_pip = resized_pip.with_position(position)
-                else:
-                    positioned_pip = resized_pip.set_position(position)
+                positioned_pip = resized_pip.with_position(position)
             except Exception as position_error:
                 print(f"设置位置失败: {position_error}")
                 return main_clip
@@ -1236,10 +1675,7 @@ class VideoProcessor:
                 # 限制画中画时长
                 pip_duration = min(pip_duration, positioned_pip.duration, main_clip.duration - pip_start_time)
                 try:
-                    if hasattr(positioned_pip, 'with_duration'):
-                        positioned_pip = positioned_pip.with_duration(pip_duration)
-                    else:
-                        positioned_pip = positioned_pip.set_duration(pip_duration)
+                    positioned_pip = positioned_pip.with_duration(pip_duration)
                     print(f"设置画中画时长: {pip_duration:.2f}s")
                 except Exception as duration_error:
                     print(f"设置时长失败: {duration_error}")
@@ -1247,10 +1683,7 @@ class VideoProcessor:
             # 设置画中画开始时间
             if pip_start_time > 0:
                 try:
-                    if hasattr(positioned_pip, 'with_start'):
-                        positioned_pip = positioned_pip.with_start(pip_start_time)
-                    else:
-                        positioned_pip = positioned_pip.set_start(pip_start_time)
+                    positioned_pip = positioned_pip.with_start(pip_start_time)
                     print(f"设置画中画开始时间: {pip_start_time:.2f}s")
                 except Exception as start_error:
                     print(f"设置开始时间失败: {start_error}")
@@ -1327,10 +1760,7 @@ class VideoProcessor:
 
                 # 应用动态位置
                 try:
-                    if hasattr(pip_clip, 'with_position'):
-                        positioned_pip = pip_clip.with_position(position_function)
-                    else:
-                        positioned_pip = pip_clip.set_position(position_function)
+                    positioned_pip = pip_clip.with_position(position_function)
                     print("应用动态位置动画")
                 except Exception as pos_error:
                     print(f"动态位置动画失败: {pos_error}")
@@ -1453,10 +1883,7 @@ class VideoProcessor:
 
             # 设置文字剪辑的持续时间
             try:
-                if hasattr(text_clip, 'with_duration'):
-                    text_clip = text_clip.with_duration(duration)
-                else:
-                    text_clip = text_clip.set_duration(duration)
+                text_clip = text_clip.with_duration(duration)
                 print(f"设置文字持续时间: {duration}s")
             except Exception as duration_error:
                 print(f"设置持续时间失败: {duration_error}")
@@ -1464,10 +1891,7 @@ class VideoProcessor:
 
             # 设置文字位置
             try:
-                if hasattr(text_clip, 'with_position'):
-                    text_clip = text_clip.with_position(text_position)
-                else:
-                    text_clip = text_clip.set_position(text_position)
+                text_clip = text_clip.with_position(text_position)
                 print(f"设置文字位置: {text_position}")
             except Exception as position_error:
                 print(f"设置文字位置失败: {position_error}")
@@ -1552,9 +1976,12 @@ class VideoProcessor:
                 print(f"创建背景剪辑失败: {bg_error}")
                 raise
 
-            # 合成文字和背景
+            # 合成文字和背景：画面全程静止，只合成一帧，再用 ImageClip 保持整段时长，
+            # 不再逐帧把文字贴到背景上
             try:
-                final_clip = CompositeVideoClip([background_clip, text_clip], size=output_size)
+                composite = CompositeVideoClip([background_clip, text_clip], size=output_size)
+                final_clip = ImageClip(composite.get_frame(0)).with_duration(duration)
+                composite.close()
                 print(f"合成最终视频剪辑成功，尺寸: {final_clip.size}, 时长: {final_clip.duration:.2f}s")
 
                 # 清理临时资源
@@ -1600,6 +2027,54 @@ class VideoProcessor:
         video.close()
 
 
+def _close_quietly(clip):
+    """关闭片段，出错只打印不抛出，避免清理时掩盖原来的异常"""
+    try:
+        clip.close()
+    except Exception as e:
+        print(f"清理资源时出错: {e}")
+
+
+def _init_worker(ffmpeg_ok, hw_write_opts):
+    """spawn 子进程的初始化函数：写入父进程已得到的 FFmpeg 检查和硬件编码器探测结果，子进程创建实例时不再重复探测"""
+    VideoProcessor._ffmpeg_ok = ffmpeg_ok
+    VideoProcessor._hw_write_opts = hw_write_opts
+
+
+def _render_beat_chunk(video_path, beat_times, first_index, output_dir, threads=None):
+    """子进程中渲染一组卡点片段，每个片段写成单独的文件，返回文件路径列表；threads 为每个进程的编码线程数"""
+    processor = VideoProcessor()
+    paths = []
+    try:
+        video = processor._open_video(video_path)
+        beat_clips = processor._create_beat_clips(video, beat_times, first_index, bake=True)
+        for k, clip in enumerate(beat_clips):
+            clip = processor._prepare_beat_clip(first_index + k, clip)
+            if clip is None:
+                continue
+            path = os.path.join(output_dir, f"beat_{first_index + k:03d}.mp4")
+            processor._write_videofile(clip, path, processor.INTERMEDIATE_WRITE_OPTS, threads)
+            paths.append(path)
+    finally:
+        processor.close()
+    return paths
+
+
+def _build_pip_segment(video1_path, video2_path, start, end, index, output_dir, threads=None):
+    """子进程中合成主体的第 index 段画中画并写成单独的文件，返回文件路径；threads 为每个进程的编码线程数"""
+    processor = VideoProcessor()
+    main_path, pip_path = (video2_path, video1_path) if index % 2 == 0 else (video1_path, video2_path)
+    try:
+        main_video = processor._open_video(main_path)
+        pip_video = processor._open_video(pip_path)
+        path = os.path.join(output_dir, f"pip_{index:02d}.mp4")
+        clip = processor._pip_segment(main_video, pip_video, start, end)
+        processor._write_videofile(clip, path, processor.INTERMEDIATE_WRITE_OPTS, threads)
+    finally:
+        processor.close()
+    return path
+
+
 # 使用示例
 if __name__ == "__main__":
     # 创建处理器实例